@@ -1,13 +1,38 @@
 import argparse
+import asyncio
+import contextvars
+import heapq
+import itertools
 import json
 import logging
+import math
 import os
+import random
+import re
+import ssl
 import threading
+import urllib.parse
+import urllib.request
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 from dataclasses import dataclass
-from time import sleep
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain, zip_longest
+from time import monotonic, sleep
+from types import SimpleNamespace
 
+import aiohttp
 import kubernetes
+import orjson
+import urllib3
+import yaml
+from aiohttp import web
 from kubernetes import watch
+from kubernetes.dynamic.exceptions import ResourceNotFoundError, ResourceNotUniqueError
+from kubernetes.dynamic.resource import Subresource
+from kubernetes.utils import parse_quantity
+from multidict import CIMultiDict
 
 logging.basicConfig(
     level=logging.INFO,
@@ -24,186 +49,2338 @@ def load_kubernetes_config() -> None:
         kubernetes.config.load_kube_config()
 
 
+# Lower goes first.
+PRIORITY_SCALE_UP = 0
+PRIORITY_DEFAULT = 1
+# Priority of the Kube API calls made in the current context (thread or asyncio task).
+API_PRIORITY: contextvars.ContextVar[int] = contextvars.ContextVar("API_PRIORITY", default=PRIORITY_DEFAULT)
+
+
+class RateLimiter:
+    """
+    client-go-like token bucket: qps tokens are added per second, up to burst. Each call takes a token,
+    waiting for one if needed; the waiters get the tokens by priority, then in arrival order.
+    A qps <= 0 disables the limit.
+    """
+
+    def __init__(self, *, name: str, qps: float, burst: int) -> None:
+        self.name, self.qps, self.burst = name, qps, max(burst, 1)
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated_at = monotonic()
+        self._waiters: list[tuple[int, int]] = []
+        self._counter = itertools.count()
+
+    def _enqueue(self, priority: int) -> tuple[int, int]:
+        ticket = (priority, next(self._counter))
+        with self._lock:
+            heapq.heappush(self._waiters, ticket)
+        return ticket
+
+    def _dequeue(self, ticket: tuple[int, int]) -> None:
+        """
+        removes the ticket of a waiter that gave up (cancelled), it would block the ones behind it otherwise.
+        """
+        with self._lock:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+
+    def _poll(self, ticket: tuple[int, int]) -> float:
+        """
+        takes a token for the ticket if it's its turn, returns 0 then, else the time to wait before polling again.
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.qps)
+            self._updated_at = now
+            if self._waiters[0] != ticket:
+                return 1 / self.qps
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.qps
+            heapq.heappop(self._waiters)
+            self._tokens -= 1
+            return 0
+
+    def _record(self, start: float) -> None:
+        STATS.inc(f"{self.name}_rate_limiter_wait_seconds", monotonic() - start)
+        STATS.inc(f"{self.name}_rate_limiter_waits")
+
+    def acquire(self, priority: int = PRIORITY_DEFAULT) -> None:
+        if self.qps <= 0:
+            return
+        start, ticket, waited = monotonic(), self._enqueue(priority), False
+        try:
+            while wait := self._poll(ticket):
+                waited = True
+                sleep(wait)
+        except BaseException as exc:
+            self._dequeue(ticket)
+            raise exc
+        # Only count the calls that had to wait for a token.
+        if waited:
+            self._record(start)
+
+    async def async_acquire(self, priority: int = PRIORITY_DEFAULT) -> None:
+        if self.qps <= 0:
+            return
+        start, ticket, waited = monotonic(), self._enqueue(priority), False
+        try:
+            while wait := self._poll(ticket):
+                waited = True
+                await asyncio.sleep(wait)
+        except asyncio.CancelledError as exc:
+            # The losing call of a hedged request e.g.
+            self._dequeue(ticket)
+            raise exc
+        # Only count the calls that had to wait for a token.
+        if waited:
+            self._record(start)
+
+
+# Rebound from the CLI args, unlimited until then.
+READ_LIMITER = RateLimiter(name="read", qps=0, burst=1)
+WRITE_LIMITER = RateLimiter(name="write", qps=0, burst=1)
+
+
+def rate_limiter(method: str) -> RateLimiter:
+    return READ_LIMITER if method.upper() in ("GET", "HEAD", "OPTIONS") else WRITE_LIMITER
+
+
+class ConcurrencyLimiter:
+    """
+    AIMD limit of the in-flight Kube API requests (watches excepted): the limit grows by one every limit
+    requests answered within latency_target, up to max_limit, and is halved (at most once per latency_target)
+    when a request is throttled (429) or times out. Retry-After is honoured: no request is sent before then.
+    A max_limit <= 0 disables the limit. Thread-safe, it can also be used from one event loop.
+    """
+
+    def __init__(self, *, initial: int, max_limit: int, latency_target: float) -> None:
+        self.limit, self.max_limit, self.latency_target = float(initial), max_limit, latency_target
+        self._changed = threading.Condition()
+        self._async_changed: asyncio.Event | None = None
+        self._in_flight = 0
+        self._retry_at = 0.0
+        self._decreased_at = float("-inf")
+
+    def _try_acquire(self, now: float) -> float:
+        """
+        takes a slot and returns 0, or returns how long to wait before trying again.
+        """
+        with self._changed:
+            if now < self._retry_at:
+                return self._retry_at - now
+            if self._in_flight >= int(self.limit):
+                return float("inf")
+            self._in_flight += 1
+            return 0
+
+    def acquire(self) -> float:
+        """
+        waits for a slot, returns the start time to pass to release.
+        """
+        if self.max_limit <= 0:
+            return monotonic()
+        with self._changed:
+            while wait := self._try_acquire(monotonic()):
+                self._changed.wait(None if wait == float("inf") else wait)
+        return monotonic()
+
+    async def async_acquire(self) -> float:
+        if self.max_limit <= 0:
+            return monotonic()
+        if self._async_changed is None:
+            self._async_changed = asyncio.Event()
+        while wait := self._try_acquire(monotonic()):
+            self._async_changed.clear()
+            try:
+                await asyncio.wait_for(self._async_changed.wait(), None if wait == float("inf") else wait)
+            except asyncio.TimeoutError:
+                pass
+        return monotonic()
+
+    def release(self, start: float, *, throttled: bool = False, retry_after: float | None = None) -> None:
+        if self.max_limit <= 0:
+            return
+        with self._changed:
+            now = monotonic()
+            self._in_flight -= 1
+            if throttled:
+                STATS.inc("throttled_requests")
+                if retry_after:
+                    self._retry_at = max(self._retry_at, now + retry_after)
+                if now - self._decreased_at >= self.latency_target:
+                    self.limit, self._decreased_at = max(1.0, self.limit / 2), now
+                    STATS.inc("concurrency_limit_decreases")
+            elif now - start <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._changed.notify_all()
+            if self._async_changed is not None:
+                self._async_changed.set()
+
+
+# Rebound from the CLI args, unlimited until then.
+CONCURRENCY = ConcurrencyLimiter(initial=0, max_limit=0, latency_target=1)
+
+
+def retry_after(headers) -> float | None:
+    """
+    returns the Retry-After of the response headers in seconds, if set (the HTTP-date form isn't used by the
+    API server).
+    """
+    try:
+        return float((headers or {}).get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_timeout(exc: Exception) -> bool:
+    """
+    checks if the urllib3 error is (or, retries exhausted, was caused by) a timeout.
+    """
+    return isinstance(exc, urllib3.exceptions.TimeoutError) or isinstance(
+        getattr(exc, "reason", None), urllib3.exceptions.TimeoutError
+    )
+
+
+# Set by --raw-json: the metric and scale responses are parsed by orjson straight from the bytes, without
+# the DynamicClient's ResourceInstance or the OpenAPI models.
+RAW_JSON = False
+
+# (connect, read) timeouts in seconds of the Kube API requests, watches excepted. Rebound from the CLI args.
+REQUEST_TIMEOUT = (5.0, 15.0)
+
+
+class RateLimitedApiClient(kubernetes.client.ApiClient):
+    """
+    ApiClient whose requests go through the read/write rate limiters. Watches excepted, they go through
+    CONCURRENCY and time out after REQUEST_TIMEOUT unless the call sets its own _request_timeout.
+    """
+
+    def request(self, method, url, query_params=None, *args, _request_timeout=None, **kwargs):
+        rate_limiter(method).acquire(API_PRIORITY.get())
+        # A watch stays idle until something changes.
+        if any(param == "watch" for param, _ in query_params or ()):
+            return super().request(method, url, query_params, *args, _request_timeout=_request_timeout, **kwargs)
+
+        start, throttled, delay = CONCURRENCY.acquire(), False, None
+        try:
+            return super().request(
+                method, url, query_params, *args, _request_timeout=_request_timeout or REQUEST_TIMEOUT, **kwargs
+            )
+        except kubernetes.client.exceptions.ApiException as exc:
+            if throttled := exc.status == 429:
+                delay = retry_after(exc.headers)
+            raise exc
+        except urllib3.exceptions.HTTPError as exc:
+            throttled = is_timeout(exc)
+            raise exc
+        finally:
+            CONCURRENCY.release(start, throttled=throttled, retry_after=delay)
+
+
 load_kubernetes_config()
-AUTOSCALING_V1 = kubernetes.client.AutoscalingV1Api()
-APP_V1 = kubernetes.client.AppsV1Api()
-DYNAMIC = kubernetes.dynamic.DynamicClient(kubernetes.client.api_client.ApiClient())
+API_CLIENT = RateLimitedApiClient()
+AUTOSCALING_V1 = kubernetes.client.AutoscalingV1Api(API_CLIENT)
+APP_V1 = kubernetes.client.AppsV1Api(API_CLIENT)
+CORE_V1 = kubernetes.client.CoreV1Api(API_CLIENT)
+DYNAMIC = kubernetes.dynamic.DynamicClient(API_CLIENT)
+
+
+@dataclass(slots=True, kw_only=True)
+class HPA:
+    name: str
+    namespace: str
+    metric_value_path: str
+    target_kind: str
+    target_name: str
+    # Empty if the scaleTargetRef doesn't set it
+    target_api_version: str = ""
+    # See hpa_fingerprint
+    fingerprint: tuple = ()
+    # See needed_replicas_from_status
+    status_needed_replicas: int | None = None
+    # Of the last evaluation, see target_at_zero
+    last_needed_replicas: int | None = None
+
+
+SYNC_INTERVAL = 30
+# Maximum time the scheduler waits before looking for new HPAs.
+SCHEDULER_TICK = 1
+LIST_PAGE_SIZE = 500
+METRICS_ANNOTATION = "autoscaling.alpha.kubernetes.io/metrics"
+CURRENT_METRICS_ANNOTATION = "autoscaling.alpha.kubernetes.io/current-metrics"
+CONDITIONS_ANNOTATION = "autoscaling.alpha.kubernetes.io/conditions"
+HPAs: dict[str, HPA] = {}
+# Current replicas and resourceVersion of the targets by target_key, only filled if the targets are watched.
+TARGETS_SCALE: dict[str, tuple[int, str]] = {}
+# Namespaces matching --namespace-label-selector, only filled if it's set.
+SELECTED_NAMESPACES: set[str] = set()
+# Monotonic time until which a needed replicas of 0 is ignored for an HPA activated by the Activator, by hpa_key.
+ACTIVATION_HOLDS: dict[str, float] = {}
+
+
+class Stats:
+    """
+    thread-safe counters, logged after each sweep.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Counter[str] = Counter()
+        self._logged_at = float("-inf")
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self) -> dict[str, float]:
+        with self._lock:
+            return dict(sorted(self._counters.items()))
+
+    def log(self, *, every: float) -> None:
+        """
+        logs the counters, at most once every `every` seconds.
+        """
+        with self._lock:
+            if monotonic() - self._logged_at < every:
+                return
+            self._logged_at = monotonic()
+        LOGGER.info(f"Stats: {self.snapshot()}")
+
+
+STATS = Stats()
+
+
+class MetricCache:
+    """
+    size-bounded LRU cache of get_needed_replicas results, shared by everything reading metrics.
+    An entry is fresh for ttl seconds, then is served stale for stale more seconds while it gets refreshed
+    in the background. Failed fetches (None) are not cached.
+    """
+
+    def __init__(self, *, ttl: float, stale: float, max_size: int) -> None:
+        self.ttl, self.stale, self.max_size = ttl, stale, max_size
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, dict[str, int]]] = OrderedDict()
+        self._revalidating: set[str] = set()
+        # Keep references to the background refresh tasks of the asyncio runtime.
+        self._tasks: set[asyncio.Task] = set()
+
+    def _lookup(self, metric_path: str) -> tuple[dict[str, int] | None, bool]:
+        """
+        returns the cached value if usable, and whether the caller should refresh it in the background.
+        """
+        with self._lock:
+            entry = self._entries.get(metric_path)
+            if entry is not None:
+                fetched_at, value = entry
+                age = monotonic() - fetched_at
+                if age <= self.ttl + self.stale:
+                    self._entries.move_to_end(metric_path)
+                    if age <= self.ttl:
+                        STATS.inc("metric_cache_hits")
+                        return value, False
+                    STATS.inc("metric_cache_stale_hits")
+                    revalidate = metric_path not in self._revalidating
+                    self._revalidating.add(metric_path)
+                    return value, revalidate
+                del self._entries[metric_path]
+            STATS.inc("metric_cache_misses")
+            return None, False
+
+    def _store(self, metric_path: str, value: dict[str, int] | None) -> None:
+        with self._lock:
+            self._revalidating.discard(metric_path)
+            if value is None:
+                return
+            self._entries[metric_path] = (monotonic(), value)
+            self._entries.move_to_end(metric_path)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                STATS.inc("metric_cache_evictions")
+
+    def _refresh(self, metric_path: str, fetch) -> None:
+        try:
+            self._store(metric_path, fetch(metric_path))
+        except Exception as exc:
+            LOGGER.exception(f"Could not refresh the cached metric at {metric_path}: {exc}")
+            self._store(metric_path, None)
+
+    def get(self, metric_path: str, fetch, refresh: bool = False) -> dict[str, int] | None:
+        """
+        returns the value for metric_path, calling fetch(metric_path) on a miss, or if refresh is set.
+        """
+        value, revalidate = (None, False) if refresh else self._lookup(metric_path)
+        if revalidate:
+            threading.Thread(target=self._refresh, args=(metric_path, fetch), daemon=True).start()
+        if value is None:
+            value = fetch(metric_path)
+            self._store(metric_path, value)
+        return value
+
+    async def _async_refresh(self, metric_path: str, fetch) -> None:
+        try:
+            self._store(metric_path, await fetch(metric_path))
+        except Exception as exc:
+            LOGGER.exception(f"Could not refresh the cached metric at {metric_path}: {exc}")
+            self._store(metric_path, None)
+
+    async def async_get(self, metric_path: str, fetch, refresh: bool = False) -> dict[str, int] | None:
+        """
+        asyncio counterpart of get, fetch being a coroutine function.
+        """
+        value, revalidate = (None, False) if refresh else self._lookup(metric_path)
+        if revalidate:
+            task = asyncio.create_task(self._async_refresh(metric_path, fetch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if value is None:
+            value = await fetch(metric_path)
+            self._store(metric_path, value)
+        return value
+
+
+METRIC_CACHE = MetricCache(ttl=10, stale=20, max_size=1024)
+
+
+class SingleFlight:
+    """
+    shares one in-flight call, and its result, between all the callers asking for the same key while it runs.
+    The key is forgotten once the call returns, the next caller makes a new call.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future | asyncio.Future] = {}
+
+    def do(self, key: str, func, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._calls[key] = Future()
+        if is_owner:
+            try:
+                future.set_result(func(*args))
+            except Exception as exc:
+                future.set_exception(exc)
+            finally:
+                with self._lock:
+                    del self._calls[key]
+        return future.result()
+
+    async def async_do(self, key: str, coroutine_func, *args):
+        # No lock needed, the event loop runs one coroutine at a time.
+        if key not in self._calls:
+            future = self._calls[key] = asyncio.ensure_future(coroutine_func(*args))
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        # A cancelled caller doesn't cancel the call shared with the others.
+        return await asyncio.shield(self._calls[key])
+
+
+# The metric fetches in flight by metric path, shared by the sweeps, the wakes, the METRIC_CACHE refreshes and the
+# fetches that outlived their sweep.
+METRIC_FLIGHT = SingleFlight()
+
+
+class CircuitBreaker:
+    """
+    stops calling a failing metrics backend: opens after failure_threshold consecutive failures, the calls then
+    fail fast for open_duration seconds, after which one call is let through (half-open) to probe the backend;
+    it closes the circuit if it succeeds, reopens it otherwise.
+    """
+
+    def __init__(self, *, name: str, failure_threshold: int, open_duration: float) -> None:
+        self.name, self.failure_threshold, self.open_duration = name, failure_threshold, open_duration
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def allow(self) -> bool:
+        """
+        returns whether the call can be made, the caller must then call record with its outcome.
+        """
+        with self._lock:
+            # A probe that never recorded its outcome doesn't block the next one.
+            if self.state != "closed" and monotonic() - self._opened_at >= self.open_duration:
+                self.state, self._opened_at = "half-open", monotonic()
+                return True
+            if self.state == "closed":
+                return True
+        STATS.inc("circuit_breaker_rejections")
+        return False
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            if success:
+                if self.state != "closed":
+                    LOGGER.info(f"Circuit breaker of {self.name} closed.")
+                self.state, self._failures = "closed", 0
+                return
+            self._failures += 1
+            if self.state == "half-open" or (self.state == "closed" and self._failures >= self.failure_threshold):
+                LOGGER.warning(
+                    f"Circuit breaker of {self.name} opened after {self._failures} consecutive failures, "
+                    f"the calls will fail fast for {self.open_duration}s."
+                )
+                STATS.inc("circuit_breaker_openings")
+                self.state, self._opened_at = "open", monotonic()
+
+
+class CircuitBreakers:
+    """
+    the circuit breakers by metrics backend (APIService or Prometheus), created on first use.
+    """
+
+    def __init__(self, *, failure_threshold: int, open_duration: float) -> None:
+        self.failure_threshold, self.open_duration = failure_threshold, open_duration
+        self._lock = threading.Lock()
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(
+                    name=name, failure_threshold=self.failure_threshold, open_duration=self.open_duration
+                )
+            return self._breakers[name]
+
+    def states(self) -> dict[str, str]:
+        with self._lock:
+            return {name: breaker.state for name, breaker in sorted(self._breakers.items())}
+
+
+CIRCUIT_BREAKERS = CircuitBreakers(failure_threshold=5, open_duration=30)
+
+
+def is_backend_failure(status: int | None) -> bool:
+    """
+    checks if the response status means the metrics backend is failing (5xx, 429), as opposed to it answering
+    that a metric has no series (404) or cannot be read (403) e.g. No status means no response (connection error,
+    timeout).
+    """
+    return status is None or status == 429 or status >= 500
+
+
+def metrics_api(metric_path: str) -> str:
+    """
+    returns the API (the APIService serving it) of the metric path, custom.metrics.k8s.io/v1beta1 e.g.
+    """
+    return "/".join(metric_path.strip("/").split("/")[1:3])
+
+
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 1000
+
+
+class Hedger:
+    """
+    times the calls and hedges the ones asked to: if the call hasn't returned after the percentile of the recent
+    durations, a duplicate call is made and the first to return a result (not None) wins.
+    """
+
+    def __init__(self, *, percentile: float, max_workers: int) -> None:
+        self.percentile = percentile
+        self._lock = threading.Lock()
+        self._durations: deque[float] = deque(maxlen=HEDGE_WINDOW)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+
+    def delay(self) -> float | None:
+        """
+        returns how long to wait before hedging, None if hedging is disabled or there are not enough durations yet.
+        """
+        with self._lock:
+            if self.percentile <= 0 or len(self._durations) < HEDGE_MIN_SAMPLES:
+                return None
+            durations = sorted(self._durations)
+        return durations[min(len(durations) - 1, int(len(durations) * self.percentile / 100))]
+
+    def _record(self, timed: tuple[object, float]):
+        """
+        records the duration of a call whose result is used, and returns that result.
+        The failed, cancelled and losing calls are not recorded, they would skew the percentile.
+        """
+        result, duration = timed
+        with self._lock:
+            self._durations.append(duration)
+        return result
+
+    @staticmethod
+    def _timed(func, *args) -> tuple[object, float]:
+        start = monotonic()
+        return func(*args), monotonic() - start
+
+    @staticmethod
+    async def _async_timed(coroutine_func, *args) -> tuple[object, float]:
+        start = monotonic()
+        return await coroutine_func(*args), monotonic() - start
+
+    def call(self, func, *args, hedge: bool = False):
+        delay = self.delay() if hedge else None
+        if delay is None:
+            return self._record(self._timed(func, *args))
+        STATS.inc("hedgeable_requests")
+        calls = [self._executor.submit(self._timed, func, *args)]
+        if not wait(calls, timeout=delay).done:
+            STATS.inc("hedged_requests")
+            calls.append(self._executor.submit(self._timed, func, *args))
+        for future in as_completed(calls):
+            if future.exception() is None and future.result()[0] is not None:
+                if future is not calls[0]:
+                    STATS.inc("hedge_wins")
+                return self._record(future.result())
+        return self._record(calls[0].result())
+
+    async def async_call(self, coroutine_func, *args, hedge: bool = False):
+        """
+        asyncio counterpart of call, the losing call is cancelled.
+        """
+        delay = self.delay() if hedge else None
+        if delay is None:
+            return self._record(await self._async_timed(coroutine_func, *args))
+        STATS.inc("hedgeable_requests")
+        calls = [asyncio.create_task(self._async_timed(coroutine_func, *args))]
+        try:
+            done, pending = await asyncio.wait(calls, timeout=delay)
+            if not done:
+                STATS.inc("hedged_requests")
+                calls.append(asyncio.create_task(self._async_timed(coroutine_func, *args)))
+                pending = set(calls)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result()[0] is not None:
+                        if task is not calls[0]:
+                            STATS.inc("hedge_wins")
+                        return self._record(task.result())
+            return self._record(calls[0].result())
+        finally:
+            for task in calls:
+                task.cancel()
+
+
+# Rebound from the CLI args, hedging is disabled until then.
+HEDGER = Hedger(percentile=0, max_workers=1)
+
+
+def target_at_zero(hpa: HPA) -> bool:
+    """
+    returns whether the target of the HPA is (or was, at the last evaluation) at zero replicas.
+    """
+    if (scale := TARGETS_SCALE.get(target_key(hpa.target_kind, hpa.namespace, hpa.target_name))) is not None:
+        return scale[0] == 0
+    return hpa.last_needed_replicas == 0
+
+
+class WorkQueue:
+    """
+    client-go-like work queue of HPA keys, each with the latest item (needed replicas) queued for it.
+    A key queued again before being processed is processed once, with the latest item; a key is never handed
+    to two workers at once (queued again while processed, it's handed out again once done); a failed key is
+    queued again after a per-key exponential backoff.
+    Thread-safe, it can also be consumed from one event loop with async_get.
+    """
+
+    def __init__(self, *, base_delay: float, max_delay: float) -> None:
+        self.base_delay, self.max_delay = base_delay, max_delay
+        self._changed = threading.Condition()
+        self._async_changed: asyncio.Event | None = None
+        self._ready: deque[str] = deque()
+        # The queued keys, with their item.
+        self._items: dict[str, object] = {}
+        # The keys handed out by get, with their item.
+        self._processing: dict[str, object] = {}
+        # The keys waiting for their backoff, the heap may have outdated entries.
+        self._delayed: list[tuple[float, str]] = []
+        self._delayed_items: dict[str, object] = {}
+        self._failures: Counter[str] = Counter()
+
+    def __len__(self) -> int:
+        with self._changed:
+            return len(self._items) + len(self._delayed_items)
+
+    def _notify(self) -> None:
+        self._changed.notify_all()
+        if self._async_changed is not None:
+            self._async_changed.set()
+
+    def _queue(self, key: str, item) -> None:
+        if key not in self._items and key not in self._processing:
+            self._ready.append(key)
+        self._items[key] = item
+
+    def add(self, key: str, item=None) -> None:
+        with self._changed:
+            # Newer than what is waiting for its backoff.
+            self._delayed_items.pop(key, None)
+            self._queue(key, item)
+            self._notify()
+
+    def done(self, key: str, *, failed: bool = False) -> None:
+        """
+        releases the key handed out by get, failed if processing it failed.
+        """
+        with self._changed:
+            item = self._processing.pop(key)
+            if key in self._items:
+                # Queued again meanwhile.
+                self._ready.append(key)
+            elif failed:
+                self._failures[key] += 1
+                delay = min(self.base_delay * 2 ** (self._failures[key] - 1), self.max_delay)
+                STATS.inc("work_queue_retries")
+                heapq.heappush(self._delayed, (monotonic() + delay, key))
+                self._delayed_items[key] = item
+            if not failed:
+                self._failures.pop(key, None)
+            self._notify()
+
+    def _pop(self, now: float) -> tuple[str, object] | float:
+        """
+        returns a ready key with its item, or how long to wait for one.
+        """
+        while self._delayed and self._delayed[0][0] <= now:
+            _, key = heapq.heappop(self._delayed)
+            if key in self._delayed_items:
+                self._queue(key, self._delayed_items.pop(key))
+        if self._ready:
+            key = self._ready.popleft()
+            item = self._processing[key] = self._items.pop(key)
+            return key, item
+        return self._delayed[0][0] - now if self._delayed else float("inf")
+
+    def get(self) -> tuple[str, object]:
+        with self._changed:
+            while isinstance(popped := self._pop(monotonic()), float):
+                self._changed.wait(None if popped == float("inf") else popped)
+            return popped
+
+    async def async_get(self) -> tuple[str, object]:
+        """
+        asyncio counterpart of get, the keys must then only be added from the event loop.
+        """
+        if self._async_changed is None:
+            self._async_changed = asyncio.Event()
+        while True:
+            with self._changed:
+                popped = self._pop(monotonic())
+            if not isinstance(popped, float):
+                return popped
+            self._async_changed.clear()
+            try:
+                await asyncio.wait_for(self._async_changed.wait(), None if popped == float("inf") else popped)
+            except asyncio.TimeoutError:
+                pass
+
+
+# HPA keys whose target needs to be updated, with the needed replicas.
+WORK_QUEUE = WorkQueue(base_delay=1, max_delay=SYNC_INTERVAL)
+
+
+def process_work_queue() -> None:
+    """
+    updates the targets of the HPAs taken from WORK_QUEUE, forever. Failures are retried by the queue.
+    """
+    while True:
+        key, needed_replicas = WORK_QUEUE.get()
+        failed = False
+        try:
+            # The HPA may have been deleted meanwhile.
+            if (hpa := HPAs.get(key)) is not None:
+                update_target(hpa, needed_replicas)
+        except Exception as exc:
+            failed = True
+            LOGGER.exception(f"Could not update the target of {key}, will retry: {exc}")
+        finally:
+            WORK_QUEUE.done(key, failed=failed)
+
+
+def interleave_by_namespace(hpas: list[HPA]) -> list[HPA]:
+    """
+    orders the HPAs round-robin across namespaces, so a namespace with many HPAs cannot delay the others.
+    """
+    by_namespace: dict[str, list[HPA]] = defaultdict(list)
+    for hpa in hpas:
+        by_namespace[hpa.namespace].append(hpa)
+    return [hpa for hpa in chain.from_iterable(zip_longest(*by_namespace.values())) if hpa is not None]
+
+
+def split_by_status(hpas: list[HPA], *, hybrid: bool) -> tuple[dict[str, int], list[HPA]]:
+    """
+    returns the needed replicas that can be taken from the HPA status, and the HPAs whose metric needs to be fetched.
+    Only in hybrid mode, otherwise all the metrics are fetched.
+    """
+    if not hybrid:
+        return {}, hpas
+    from_status = {hpa_key(hpa): hpa.status_needed_replicas for hpa in hpas if hpa.status_needed_replicas is not None}
+    STATS.inc("needed_replicas_from_hpa_status", len(from_status))
+    return from_status, [hpa for hpa in hpas if hpa_key(hpa) not in from_status]
+
+
+def sweep(
+    executor: ThreadPoolExecutor,
+    hpas: list[HPA],
+    *,
+    hybrid: bool = False,
+    refresh: bool = False,
+    deadline: float | None = None,
+) -> dict[str, int | None]:
+    """
+    fetches the metrics of the HPAs on the executor, queues their targets' update in WORK_QUEUE and returns the
+    needed replicas of each of them. With refresh, the metrics are fetched even if cached.
+    The HPAs whose metric was not fetched by the deadline (monotonic time) are left out, see count_carried_over.
+    """
+    start = monotonic()
+    hpas = interleave_by_namespace(hpas)
+    from_status, polled_hpas = split_by_status(hpas, hybrid=hybrid)
+    if PROMETHEUS is not None:
+        needed_replicas = from_status | PROMETHEUS.get_needed_replicas(executor, polled_hpas)
+    else:
+        groups = group_by_metric_path(polled_hpas)
+
+        def _get_needed_replicas_once(metric_path: str, refresh: bool, at_zero: bool) -> dict[str, int] | None:
+            # Latency matters when waking up a target, a cached value would also delay it past --zero-sync-interval.
+            fetch = partial(HEDGER.call, get_needed_replicas, hedge=at_zero)
+            return METRIC_CACHE.get(metric_path, partial(METRIC_FLIGHT.do, metric_path, fetch), refresh or at_zero)
+
+        futures = {
+            metric_path: executor.submit(
+                _get_needed_replicas_once, metric_path, refresh, any(map(target_at_zero, group))
+            )
+            for metric_path, group in groups.items()
+        }
+        # The late ones keep running, they'll fill METRIC_CACHE for the next sweep.
+        done, _ = wait(futures.values(), timeout=None if deadline is None else max(0, deadline - monotonic()))
+        fetched = {metric_path: group for metric_path, group in groups.items() if futures[metric_path] in done}
+        results = [futures[metric_path].result() for metric_path in fetched]
+        needed_replicas = from_status | needed_replicas_per_hpa(fetched, results)
+    count_carried_over(hpas, needed_replicas)
+    queue_updates(hpas, needed_replicas)
+    count_sweep(hpas, polled_hpas, start)
+    return needed_replicas
+
+
+def queue_updates(hpas: list[HPA], needed_replicas: dict[str, int | None]) -> None:
+    """
+    queues the update of the evaluated HPAs' targets.
+    """
+    for hpa in hpas:
+        if (key := hpa_key(hpa)) not in needed_replicas:
+            continue
+        if needed_replicas[key] == 0 and activation_held(key):
+            continue
+        if needed_replicas[key] is not None:
+            hpa.last_needed_replicas = needed_replicas[key]
+        WORK_QUEUE.add(key, needed_replicas[key])
+
+
+def activation_held(key: str) -> bool:
+    """
+    checks if the HPA was activated recently, its metric may not reflect the requests held by the Activator yet.
+    """
+    return monotonic() < ACTIVATION_HOLDS.get(key, float("-inf"))
+
+
+def hold_activation(hpas: list[HPA], duration: float) -> None:
+    """
+    ignores a needed replicas of 0 for the HPAs during duration seconds, see activation_held.
+    """
+    for hpa in hpas:
+        ACTIVATION_HOLDS[hpa_key(hpa)] = monotonic() + duration
+
+
+def activate(hpas: list[HPA], *, hold: float) -> None:
+    """
+    queues the scale up of the HPAs' targets to (at least) one replica, held for hold seconds.
+    """
+    hold_activation(hpas, hold)
+    # Through the queue, so that each target is only ever updated by one worker at a time.
+    for hpa in hpas:
+        WORK_QUEUE.add(hpa_key(hpa), 1)
+
+
+def count_sweep(hpas: list[HPA], polled_hpas: list[HPA], start: float) -> None:
+    """
+    counts the sweep and its duration in STATS, logged every SYNC_INTERVAL, the sweeps are too many to log each.
+    """
+    duration = monotonic() - start
+    STATS.inc("sweeps")
+    STATS.inc("sweep_seconds", duration)
+    LOGGER.debug(f"Sweep over {len(hpas)} HPA ({len(polled_hpas)} polled) took {duration:.3f}s.")
+
+
+def count_carried_over(hpas: list[HPA], needed_replicas: dict[str, int | None]) -> None:
+    """
+    counts the sweep's HPAs that were not evaluated before its deadline, they're carried over to the next sweep.
+    """
+    if carried_over := sum(hpa_key(hpa) not in needed_replicas for hpa in hpas):
+        LOGGER.warning(f"Sweep deadline exceeded, {carried_over} HPA carried over to the next sweep.")
+        STATS.inc("sweep_deadline_overruns")
+        STATS.inc("sweep_carried_over_hpas", carried_over)
+
+
+def adapt_interval(interval: float, needed_replicas: int | None, *, zero_interval: float, max_interval: float) -> float:
+    """
+    returns the interval until the next evaluation of an HPA: short while its target is at zero, as waking it up
+    fast is what matters, then doubling at each evaluation while the target stays active, up to max_interval.
+    """
+    match needed_replicas:
+        case 0:
+            return zero_interval
+        case None:
+            return interval
+        case _:
+            return max(zero_interval, min(interval * 2, max_interval))
+
+
+class Scheduler:
+    """
+    keeps the HPA keys in a heap by the time their next evaluation is due. Each HPA is evaluated every interval
+    on its own schedule, so the evaluations, thus the API load, are spread over the interval instead of coming
+    in bursts, and the worst-case detection latency stays around one interval.
+    """
+
+    def __init__(
+        self, *, interval: float, jitter: float, zero_interval: float | None = None, max_interval: float | None = None
+    ) -> None:
+        self.interval, self.jitter = interval, jitter
+        # See adapt_interval, the interval is fixed by default.
+        self.zero_interval = interval if zero_interval is None else zero_interval
+        self.max_interval = interval if max_interval is None else max_interval
+        self._heap: list[tuple[float, str]] = []
+        self._scheduled: set[str] = set()
+        self._intervals: dict[str, float] = {}
+
+    def pop_due(self, hpas: dict[str, HPA], now: float) -> list[tuple[float, HPA]]:
+        """
+        schedules the new HPAs, spread evenly over the next interval (the first one being due now), and returns
+        the due HPAs with their due time. Keys not in hpas anymore are dropped once due.
+        """
+        new_keys = [key for key in hpas if key not in self._scheduled]
+        for i, key in enumerate(new_keys):
+            heapq.heappush(self._heap, (now + self.interval * i / len(new_keys), key))
+            self._scheduled.add(key)
+
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due_time, key = heapq.heappop(self._heap)
+            if key in hpas:
+                due.append((due_time, hpas[key]))
+            else:
+                self._scheduled.discard(key)
+                self._intervals.pop(key, None)
+        for due_time, _ in due:
+            STATS.inc("scheduler_lateness_seconds", now - due_time)
+        return due
+
+    def reschedule(self, hpa: HPA, due_time: float, now: float, needed_replicas: int | None = None) -> None:
+        """
+        schedules the next evaluation of the HPA one interval (with jitter) after the previous due time, the
+        interval being adapted to the needed replicas of the evaluation.
+        If that is already past, the evaluation overran its slot and the HPA is due immediately.
+        """
+        key = hpa_key(hpa)
+        interval = self._intervals[key] = adapt_interval(
+            self._intervals.get(key, self.interval),
+            needed_replicas,
+            zero_interval=self.zero_interval,
+            max_interval=self.max_interval,
+        )
+        next_due_time = due_time + interval * (1 + random.uniform(-self.jitter, self.jitter))
+        if next_due_time < now:
+            STATS.inc("scheduler_overruns")
+            next_due_time = now
+        heapq.heappush(self._heap, (next_due_time, key))
+
+    def carry_over(self, hpa: HPA, due_time: float) -> None:
+        """
+        schedules the HPA, not evaluated, at its previous due time, so it goes first in the next sweep.
+        """
+        heapq.heappush(self._heap, (due_time, hpa_key(hpa)))
+
+    def reschedule_sweep(self, due: list[tuple[float, HPA]], needed_replicas: dict[str, int | None]) -> None:
+        """
+        reschedules the HPAs returned by pop_due once swept, the HPAs left out by the sweep are carried over.
+        """
+        for due_time, hpa in due:
+            if (key := hpa_key(hpa)) in needed_replicas:
+                self.reschedule(hpa, due_time, monotonic(), needed_replicas[key])
+            else:
+                self.carry_over(hpa, due_time)
+
+    def wait_time(self, now: float) -> float:
+        """
+        returns how long to wait before the next HPA is due, capped so new HPAs are picked up quickly.
+        """
+        if not self._heap:
+            return SCHEDULER_TICK
+        return max(0, min(self._heap[0][0] - now, SCHEDULER_TICK))
+
+
+def new_scheduler(args) -> Scheduler:
+    return Scheduler(
+        interval=SYNC_INTERVAL,
+        jitter=args.sync_jitter,
+        zero_interval=args.zero_sync_interval,
+        max_interval=args.max_sync_interval,
+    )
+
+
+def watch_metrics(args) -> None:
+    """
+    periodically watches metrics of HPA and scale the targets accordingly if needed.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=args.sync_workers, thread_name_prefix="sync")
+
+    # TODO: See if we can use Kubernetes's watch mechanism
+    def _watch():
+        try:
+            scheduler = new_scheduler(args)
+            with executor:
+                while True:
+                    # The HPAs due at the same time are updated together, sharing the metric requests.
+                    due = scheduler.pop_due({hpa_key(hpa): hpa for hpa in selected_hpas(args)}, monotonic())
+                    if due:
+                        needed_replicas = sweep(
+                            executor,
+                            [hpa for _, hpa in due],
+                            hybrid=args.hybrid,
+                            deadline=monotonic() + args.sweep_deadline,
+                        )
+                        scheduler.reschedule_sweep(due, needed_replicas)
+                    STATS.log(every=SYNC_INTERVAL)
+                    sleep(scheduler.wait_time(monotonic()))
+        except Exception as exc:
+            LOGGER.exception(f"Exiting because of: {exc}")
+            os._exit(1)
+
+    threading.Thread(target=_watch, daemon=True).start()
+    for i in range(args.sync_workers):
+        threading.Thread(target=process_work_queue, name=f"update-{i}", daemon=True).start()
+    if args.webhook_port:
+        serve_webhook(args)
+
+
+def wake(args, hpas: list[HPA]) -> None:
+    """
+    scales the targets of the HPAs up right away, their metric may not reflect the incoming requests yet.
+    """
+    LOGGER.info(f"Waking up the targets of {[hpa_key(hpa) for hpa in hpas]}.")
+    STATS.inc("webhook_wakes", len(hpas))
+    activate(hpas, hold=args.activator_grace_period)
+
+
+def hpas_matching_alerts(hpas: list[HPA], alerts: list[dict]) -> list[HPA]:
+    """
+    returns the HPAs targeted by the firing alerts of an Alertmanager webhook payload.
+    An alert targets an HPA via its namespace label and either its horizontalpodautoscaler label (HPA name)
+    or its service label (the Service the HPA metric is about).
+    """
+    matching = {}
+    for alert in alerts:
+        labels = alert.get("labels", {})
+        if alert.get("status") != "firing":
+            continue
+        for hpa in hpas:
+            if hpa.namespace == labels.get("namespace") and (
+                hpa.name == labels.get("horizontalpodautoscaler") or service_name(hpa) == labels.get("service")
+            ):
+                matching[hpa_key(hpa)] = hpa
+    return list(matching.values())
+
+
+def hpas_to_wake(args, path: str, body: bytes) -> tuple[int, list[HPA]]:
+    """
+    returns the HTTP status to reply with and the HPAs to wake up for a POST on the webhook:
+    - /wake/{namespace}/{name}: the HPA namespace/name.
+    - /alertmanager: see hpas_matching_alerts.
+    """
+    hpas = selected_hpas(args)
+    match path.strip("/").split("/"):
+        case ["wake", namespace, name]:
+            hpa = next((hpa for hpa in hpas if hpa.namespace == namespace and hpa.name == name), None)
+            return (202, [hpa]) if hpa else (404, [])
+        case ["alertmanager"]:
+            try:
+                alerts = json.loads(body)["alerts"]
+            except (ValueError, KeyError, TypeError):
+                return 400, []
+            return 202, hpas_matching_alerts(hpas, alerts)
+        case _:
+            return 404, []
+
+
+def stats() -> dict:
+    """
+    returns what GET /stats serves: STATS and the state of the limiters and circuit breakers.
+    """
+    return STATS.snapshot() | {"concurrency_limit": CONCURRENCY.limit, "circuit_breakers": CIRCUIT_BREAKERS.states()}
+
+
+def serve_webhook(args) -> None:
+    """
+    serves, on args.webhook_port, the endpoints of hpas_to_wake, calling wake (the targets are updated by the queue
+    workers, the caller doesn't wait for them), and GET /stats.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self) -> None:
+            status, hpas = hpas_to_wake(args, self.path, self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if hpas:
+                wake(args, hpas)
+            self._reply(status, {"woken": [hpa_key(hpa) for hpa in hpas]})
+
+        def do_GET(self) -> None:
+            if self.path.rstrip("/") == "/stats":
+                self._reply(200, stats())
+            else:
+                self._reply(404, {})
+
+        def log_message(self, format, *log_args) -> None:
+            LOGGER.debug(format % log_args)
+
+    server = ThreadingHTTPServer(("", args.webhook_port), Handler)
+    LOGGER.info(f"Will serve the webhook on port {args.webhook_port}.")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def selected_hpas(args) -> list[HPA]:
+    """
+    returns the HPAs living in the namespaces matching --namespace-label-selector, all of them if not set.
+    """
+    return [hpa for hpa in list(HPAs.values()) if is_selected(hpa, args)]
+
+
+def is_selected(hpa: HPA, args) -> bool:
+    """
+    checks if the HPA lives in a namespace matching --namespace-label-selector, if set.
+    """
+    return not args.namespace_label_selector or hpa.namespace in SELECTED_NAMESPACES
+
+
+def watched_namespaces(args) -> str:
+    return "all namespaces" if args.all_namespaces else f"namespace {args.hpa_namespace}"
+
+
+def list_call(args, namespaced_func, all_namespaces_func) -> tuple:
+    """
+    returns the function listing the resources in the watched namespace(s), and its positional args.
+    (functools.partial cannot be used, Watch.stream relies on the function's docstring)
+    """
+    if args.all_namespaces:
+        return all_namespaces_func, ()
+    return namespaced_func, (args.hpa_namespace,)
+
+
+def list_hpa_call(args) -> tuple:
+    return list_call(
+        args,
+        AUTOSCALING_V1.list_namespaced_horizontal_pod_autoscaler,
+        AUTOSCALING_V1.list_horizontal_pod_autoscaler_for_all_namespaces,
+    )
+
+
+def namespace_path(args) -> str:
+    """
+    returns the Kube API path segment restricting a list/watch to the watched namespace(s).
+    """
+    return "" if args.all_namespaces else f"namespaces/{args.hpa_namespace}/"
+
+
+def watch_namespaces(args) -> None:
+    """
+    keeps SELECTED_NAMESPACES in sync with the namespaces matching --namespace-label-selector.
+    Namespaces that stop matching the selector are received as DELETED.
+    """
+
+    def _watch():
+        try:
+            while True:
+                try:
+                    w = watch.Watch()
+                    for event in w.stream(CORE_V1.list_namespace, label_selector=args.namespace_label_selector):
+                        name = event["object"].metadata.name
+                        if event["type"] == "DELETED":
+                            SELECTED_NAMESPACES.discard(name)
+                        else:
+                            SELECTED_NAMESPACES.add(name)
+                except kubernetes.client.exceptions.ApiException as exc:
+                    if exc.status != 410:
+                        raise exc
+                    SELECTED_NAMESPACES.clear()
+        except Exception as exc:
+            LOGGER.exception(f"Exiting because of: {exc}")
+            os._exit(1)
+
+    LOGGER.info(f"Will watch namespaces with {args.namespace_label_selector=}.")
+    threading.Thread(target=_watch, daemon=True).start()
+
+
+def watch_hpa(args) -> None:
+    """
+    watches the HPA from the last seen resourceVersion (bookmarks included), the HPA are only relisted
+    when that resourceVersion is too old (410).
+    """
+    LOGGER.info(f"Will watch HPA with {args.hpa_label_selector=} in {watched_namespaces(args)}.")
+    resource_version = None
+    while True:
+        try:
+            if resource_version is None:
+                resource_version = relist_hpa(args)
+            list_func, list_args = list_hpa_call(args)
+            w = watch.Watch()
+            for event in w.stream(
+                list_func,
+                *list_args,
+                label_selector=args.hpa_label_selector,
+                resource_version=resource_version,
+                allow_watch_bookmarks=True,
+            ):
+                if event["type"] == "BOOKMARK":
+                    resource_version = event["raw_object"]["metadata"]["resourceVersion"]
+                    # The Watch only keeps track of the other events' resourceVersion to resume from.
+                    w.resource_version = resource_version
+                    continue
+                resource_version = event["object"].metadata.resource_version
+                update_hpa(event, args)
+        except kubernetes.client.exceptions.ApiException as exc:
+            if exc.status != 410:
+                raise exc
+            LOGGER.info(f"HPA watch from {resource_version=} expired, will relist.")
+            resource_version = None
+
+
+def relist_hpa(args) -> str:
+    """
+    lists the HPA page by page, syncs HPAs with them and returns the resourceVersion to watch from.
+    """
+    list_func, list_args = list_hpa_call(args)
+    hpas, _continue = [], None
+    while True:
+        hpa_list = list_func(
+            *list_args, label_selector=args.hpa_label_selector, limit=LIST_PAGE_SIZE, _continue=_continue
+        )
+        hpas.extend(hpa_list.items)
+        if not (_continue := hpa_list.metadata._continue):
+            break
+    replace_hpas(hpas)
+    return hpa_list.metadata.resource_version
+
+
+def replace_hpas(hpas) -> None:
+    """
+    stores the listed V1HorizontalPodAutoscaler and forgets the HPA that are not listed anymore.
+    """
+    listed = set()
+    for hpa in hpas:
+        listed.add(f"{hpa.metadata.namespace}/{hpa.metadata.name}")
+        store_hpa(hpa)
+    for key in set(HPAs) - listed:
+        LOGGER.info(f"HPA {key} is not listed anymore, will forget about it.")
+        HPAs.pop(key, None)
+
+
+def target_key(kind: str, namespace: str, name: str) -> str:
+    return f"{kind}/{namespace}/{name}"
+
+
+def watch_targets(args) -> None:
+    """
+    keeps TARGETS_SCALE in sync with the watched Deployments and StatefulSets, so their current replicas
+    don't need to be read before each scaling decision.
+    """
+
+    def _watch(kind: str, list_func, list_args):
+        try:
+            while True:
+                try:
+                    w = watch.Watch()
+                    for event in w.stream(list_func, *list_args):
+                        metadata = event["object"].metadata
+                        key = target_key(kind, metadata.namespace, metadata.name)
+                        if event["type"] == "DELETED":
+                            TARGETS_SCALE.pop(key, None)
+                        else:
+                            TARGETS_SCALE[key] = (event["object"].status.replicas or 0, metadata.resource_version)
+                except kubernetes.client.exceptions.ApiException as exc:
+                    if exc.status != 410:
+                        raise exc
+                    # Forget what may have been deleted meanwhile, the scale subresource is read until relisted.
+                    # A snapshot, the watch of the other kind keeps writing to TARGETS_SCALE.
+                    for key in [key for key in list(TARGETS_SCALE) if key.startswith(f"{kind}/")]:
+                        TARGETS_SCALE.pop(key, None)
+        except Exception as exc:
+            LOGGER.exception(f"Exiting because of: {exc}")
+            os._exit(1)
+
+    LOGGER.info(f"Will watch Deployments and StatefulSets in {watched_namespaces(args)}.")
+    for kind, list_funcs in (
+        ("Deployment", (APP_V1.list_namespaced_deployment, APP_V1.list_deployment_for_all_namespaces)),
+        ("StatefulSet", (APP_V1.list_namespaced_stateful_set, APP_V1.list_stateful_set_for_all_namespaces)),
+    ):
+        threading.Thread(target=_watch, args=(kind, *list_call(args, *list_funcs)), daemon=True).start()
+
+
+def update_hpa(event, args) -> None:
+    """
+    inserts/updates/deletes the HPA to/in/from HPAs using the watch event, the event carries the whole object.
+    In hybrid mode, the target of a selected HPA is updated right away when the needed replicas in its status change.
+    """
+    hpa = event["object"]
+    key = f"{hpa.metadata.namespace}/{hpa.metadata.name}"
+    if event["type"] == "DELETED":
+        LOGGER.info(f"HPA {key} was deleted, will forget about it.")
+        HPAs.pop(key, None)
+        return
+    previous = HPAs[key].status_needed_replicas if key in HPAs else None
+    store_hpa(hpa)
+    if not args.hybrid or not is_selected(HPAs[key], args):
+        return
+    needed_replicas = HPAs[key].status_needed_replicas
+    if needed_replicas in (None, previous) or (needed_replicas == 0 and activation_held(key)):
+        return
+    WORK_QUEUE.add(key, needed_replicas)
+
+
+def hpa_fingerprint(hpa) -> tuple:
+    """
+    returns the inputs store_hpa uses from the V1HorizontalPodAutoscaler.
+    The HPA controller rewrites the status (and the status annotations) on each of its syncs, these don't matter here.
+    """
+    return (
+        hpa.metadata.generation,
+        (hpa.metadata.annotations or {}).get(METRICS_ANNOTATION),
+        hpa.spec.scale_target_ref.api_version,
+        hpa.spec.scale_target_ref.kind,
+        hpa.spec.scale_target_ref.name,
+    )
+
+
+def store_hpa(hpa) -> None:
+    """
+    inserts/updates the HPA built from the V1HorizontalPodAutoscaler in HPAs, if what it's built from changed.
+    """
+    key = f"{hpa.metadata.namespace}/{hpa.metadata.name}"
+    fingerprint = hpa_fingerprint(hpa)
+    if (current := HPAs.get(key)) is not None and current.fingerprint == fingerprint:
+        STATS.inc("hpa_updates_skipped")
+    else:
+        STATS.inc("hpa_updates_applied")
+        LOGGER.info(f"HPA: {hpa}")
+        current = HPAs[key] = HPA(
+            name=hpa.metadata.name,
+            namespace=hpa.metadata.namespace,
+            metric_value_path=build_metric_value_path(hpa),
+            target_kind=hpa.spec.scale_target_ref.kind,
+            target_name=hpa.spec.scale_target_ref.name,
+            target_api_version=hpa.spec.scale_target_ref.api_version or "",
+            fingerprint=fingerprint,
+        )
+    # The status changes on each HPA controller sync.
+    current.status_needed_replicas = needed_replicas_from_status(hpa, metric_name=metric_name(current))
+
+
+def needed_replicas_from_status(hpa, *, metric_name: str) -> int | None:
+    """
+    returns the needed replicas based on the metric value the HPA controller wrote in the V1HorizontalPodAutoscaler
+    status, this saves a request while the target is active.
+    returns None if the target has no replicas (the HPA controller doesn't fetch metrics then, ScalingDisabled), or if
+    the HPA controller is not able to get the metric (ScalingActive is not True).
+    """
+    if not (hpa.status and hpa.status.current_replicas):
+        return None
+    annotations = hpa.metadata.annotations or {}
+    conditions = json.loads(annotations.get(CONDITIONS_ANNOTATION, "[]"))
+    if not any(c["type"] == "ScalingActive" and c["status"] == "True" for c in conditions):
+        return None
+    for current_metric in json.loads(annotations.get(CURRENT_METRICS_ANNOTATION, "[]")):
+        metric = current_metric.get(current_metric["type"].lower(), {})
+        if metric.get("metricName") == metric_name:
+            value = metric.get("currentValue", metric.get("currentAverageValue"))
+            return None if value is None else needed_replicas_from_value(value)
+    return None
+
+
+def build_metric_value_path(hpa) -> str:
+    """
+    returns the Kube API path to retrieve the custom.metrics.k8s.io used metric.
+    """
+    metrics = json.loads(hpa.metadata.annotations[METRICS_ANNOTATION])
+    LOGGER.info(f"metrics: {metrics}")
+    try:
+        custom_metric = next(m["external"] for m in metrics if m["type"] == "External")
+        assert not custom_metric.get("selector")
+        target = custom_metric["target"]
+        assert target["kind"] == "Service"
+    except (StopIteration, AssertionError) as e:
+        LOGGER.exception("Only supports ONE CUSTOM metric without selector based on service for now.")
+        raise e
+
+    service_namespace = hpa.metadata.namespace
+    service_name = target["name"]
+    metric_name = custom_metric["metricName"]
+
+    return f"apis/custom.metrics.k8s.io/v1beta1/namespaces/{service_namespace}/services/{service_name}/{metric_name}"
+
+
+def build_metric_list_path(metric_value_path: str) -> str:
+    """
+    returns the Kube API path to retrieve the metric for all the services of the namespace at once.
+    """
+    prefix, _, metric_name = metric_value_path.rsplit("/", 2)
+    return f"{prefix}/*/{metric_name}"
+
+
+def service_name(hpa: HPA) -> str:
+    return hpa.metric_value_path.rsplit("/", 2)[1]
+
+
+def metric_name(hpa: HPA) -> str:
+    return hpa.metric_value_path.rsplit("/", 1)[1]
+
+
+def hpa_key(hpa: HPA) -> str:
+    """
+    returns the key of the HPA in HPAs.
+    """
+    return f"{hpa.namespace}/{hpa.name}"
+
+
+def group_by_metric_path(hpas: list[HPA]) -> dict[str, list[HPA]]:
+    """
+    groups the HPAs using the same metric in the same namespace, so one request returns the values for all of them.
+    A group whose HPAs all share the same metric_value_path (one HPA e.g.) keeps it, no need to make
+    prometheus-adapter compute the other services.
+    """
+    groups: dict[str, list[HPA]] = defaultdict(list)
+    for hpa in hpas:
+        groups[build_metric_list_path(hpa.metric_value_path)].append(hpa)
+    return {
+        (path if len({hpa.metric_value_path for hpa in group}) > 1 else group[0].metric_value_path): group
+        for path, group in groups.items()
+    }
+
+
+def needed_replicas_from_value(value: str) -> int:
+    """
+    returns 0 if the metric value (a quantity: "0", "500m", "15k"...) is 0, and 1 otherwise
+    (HPA will take care of scaling up if needed).
+    """
+    return int(parse_quantity(value) > 0)
+
+
+def needed_replicas_by_service(metric_value_list: dict) -> dict[str, int]:
+    """
+    returns needed_replicas_from_value for each service described in the MetricValueList.
+    """
+    return {
+        item["describedObject"]["name"]: needed_replicas_from_value(item["value"])
+        for item in metric_value_list["items"]
+    }
+
+
+def needed_replicas_per_hpa(groups: dict[str, list[HPA]], results) -> dict[str, int | None]:
+    """
+    maps the results of get_needed_replicas for each group of group_by_metric_path back to the HPAs.
+    """
+    needed_replicas = {}
+    for group, by_service in zip(groups.values(), results):
+        for hpa in group:
+            needed_replicas[hpa_key(hpa)] = None if by_service is None else by_service.get(service_name(hpa))
+    return needed_replicas
+
+
+def get_needed_replicas(metric_path) -> dict[str, int] | None:
+    """
+    returns needed_replicas_by_service for a path built by build_metric_value_path or build_metric_list_path.
+    returns None, if the needed replicas cannot be determined.
+    """
+    breaker = CIRCUIT_BREAKERS.get(metrics_api(metric_path))
+    if not breaker.allow():
+        return None
+    try:
+        if RAW_JSON:
+            metric_value_list = orjson.loads(DYNAMIC.request("GET", metric_path, serialize=False).data)
+        else:
+            metric_value_list = DYNAMIC.request("GET", metric_path).to_dict()
+        needed_replicas = needed_replicas_by_service(metric_value_list)
+    except kubernetes.client.exceptions.ApiException as exc:
+        breaker.record(not is_backend_failure(exc.status))
+        if exc.status not in (403, 404) and not is_backend_failure(exc.status):
+            raise exc
+        LOGGER.error(f"Could not get Custom metric at {metric_path}: {exc.status} {exc.reason}")
+    except urllib3.exceptions.HTTPError as exc:
+        breaker.record(False)
+        LOGGER.error(f"Could not get Custom metric at {metric_path}: {exc}")
+    else:
+        breaker.record(True)
+        return needed_replicas
+
+
+def render_adapter_template(template: str, **values: str) -> str:
+    """
+    renders the <<.Key>> placeholders of a prometheus-adapter metricsQuery.
+    """
+    return re.sub(r"<<\s*\.(\w+)\s*>>", lambda match: values[match.group(1)], template)
+
+
+class PrometheusBackend:
+    """
+    evaluates the metrics of the HPAs directly against Prometheus, instead of going through the custom metrics API
+    (API server -> prometheus-adapter -> Prometheus, one PromQL query per request).
+    The metrics are defined by prometheus-adapter rules (the "rules" of its config file, or the Helm chart's
+    rules.custom), all the HPAs using the same metric are evaluated with one query per sweep.
+    """
+
+    def __init__(self, *, url: str, rules: list[dict], timeout: float) -> None:
+        self.url, self.timeout = url.rstrip("/"), timeout
+        # metric name, as exposed by the adapter -> (series name, rule)
+        self.rules: dict[str, tuple[str, dict]] = {}
+        for rule in rules:
+            if (series := self._series_name(rule["seriesQuery"])) is None:
+                LOGGER.error(
+                    f"Skipping the prometheus-adapter rule with seriesQuery {rule['seriesQuery']}: only the rules "
+                    'selecting one series by name, foo{...} or {__name__="foo",...}, are supported.'
+                )
+                continue
+            name = rule.get("name", {})
+            regex = re.compile(name.get("matches", "^(.*)$"))
+            if (match := regex.search(series)) is None:
+                continue
+            exposed = name.get("as") or ("${1}" if regex.groups else "${0}")
+            exposed = re.sub(r"\$\{?(\d+)\}?", lambda group: match.group(int(group.group(1))), exposed)
+            self.rules[exposed] = (series, rule)
+        self._session: aiohttp.ClientSession | None = None
+
+    @staticmethod
+    def _series_name(series_query: str) -> str | None:
+        """
+        returns the name of the series selected by the seriesQuery, None if it selects several (__name__=~ e.g.),
+        they would have to be discovered.
+        """
+        if series := series_query.split("{", 1)[0].strip():
+            return series
+        if match := re.search(r'__name__\s*=\s*"([^"]+)"', series_query):
+            return match.group(1)
+        return None
+
+    @classmethod
+    def from_rules_file(cls, *, url: str, path: str, timeout: float) -> "PrometheusBackend":
+        with open(path) as f:
+            rules = yaml.safe_load(f)["rules"]
+        # The Helm chart's values nest them.
+        return cls(url=url, rules=rules["custom"] if isinstance(rules, dict) else rules, timeout=timeout)
+
+    @staticmethod
+    def _resource_label(rule: dict, resource: str) -> str:
+        resources = rule.get("resources", {})
+        for label, override in resources.get("overrides", {}).items():
+            if override.get("resource") == resource:
+                return label
+        return render_adapter_template(resources.get("template", "<<.Resource>>"), Resource=resource)
+
+    def build_queries(self, hpas: list[HPA]) -> dict[str, tuple[list[HPA], str, str]]:
+        """
+        returns, for each metric, the query evaluating it for all the HPAs using it, with these HPAs and the names
+        of the namespace and service labels of the result.
+        """
+        by_metric: dict[str, list[HPA]] = defaultdict(list)
+        for hpa in hpas:
+            by_metric[metric_name(hpa)].append(hpa)
+
+        queries = {}
+        for metric, metric_hpas in by_metric.items():
+            if metric not in self.rules:
+                LOGGER.error(f"No prometheus-adapter rule for {metric}, used by {[hpa_key(h) for h in metric_hpas]}.")
+                continue
+            series, rule = self.rules[metric]
+            namespace_label = self._resource_label(rule, "namespace")
+            service_label = self._resource_label(rule, "service")
+            namespaces = "|".join(sorted({hpa.namespace for hpa in metric_hpas}))
+            services = "|".join(sorted({service_name(hpa) for hpa in metric_hpas}))
+            query = render_adapter_template(
+                rule["metricsQuery"],
+                Series=series,
+                LabelMatchers=f'{namespace_label}=~"{namespaces}",{service_label}=~"{services}"',
+                GroupBy=f"{namespace_label},{service_label}",
+            )
+            queries[query] = (metric_hpas, namespace_label, service_label)
+        return queries
+
+    @staticmethod
+    def needed_replicas_from_vector(
+        vector: list[dict] | None, hpas: list[HPA], namespace_label: str, service_label: str
+    ) -> dict[str, int | None]:
+        """
+        returns the needed replicas for each HPA from the query's instant vector (None if the query failed).
+        """
+        values = {}
+        for sample in vector or []:
+            value = float(sample["value"][1])
+            if not math.isnan(value):
+                values[(sample["metric"].get(namespace_label), sample["metric"].get(service_label))] = int(value > 0)
+        return {hpa_key(hpa): values.get((hpa.namespace, service_name(hpa))) for hpa in hpas}
+
+    def query(self, query: str) -> list[dict] | None:
+        """
+        returns the instant vector of the query, None if it failed.
+        """
+        breaker = CIRCUIT_BREAKERS.get("prometheus")
+        if not breaker.allow():
+            return None
+        STATS.inc("prometheus_queries")
+        request = urllib.request.Request(
+            f"{self.url}/api/v1/query", data=urllib.parse.urlencode({"query": query}).encode(), method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                vector = json.load(response)["data"]["result"]
+        except (OSError, ValueError, KeyError) as exc:
+            breaker.record(not is_backend_failure(getattr(exc, "code", None)))
+            LOGGER.error(f"Could not query Prometheus with {query}: {exc}")
+            return None
+        breaker.record(True)
+        return vector
+
+    async def async_query(self, query: str) -> list[dict] | None:
+        """
+        asyncio counterpart of query.
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        breaker = CIRCUIT_BREAKERS.get("prometheus")
+        if not breaker.allow():
+            return None
+        STATS.inc("prometheus_queries")
+        try:
+            async with self._session.post(f"{self.url}/api/v1/query", data={"query": query}) as response:
+                response.raise_for_status()
+                vector = (await response.json())["data"]["result"]
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as exc:
+            breaker.record(not is_backend_failure(getattr(exc, "status", None)))
+            LOGGER.error(f"Could not query Prometheus with {query}: {exc!r}")
+            return None
+        breaker.record(True)
+        return vector
+
+    def get_needed_replicas(self, executor: ThreadPoolExecutor, hpas: list[HPA]) -> dict[str, int | None]:
+        """
+        returns the needed replicas for each HPA, the HPAs whose metric cannot be evaluated get None.
+        """
+        queries = self.build_queries(hpas)
+        needed_replicas = dict.fromkeys(map(hpa_key, hpas))
+        for (query_hpas, *labels), vector in zip(queries.values(), executor.map(self.query, queries)):
+            needed_replicas |= self.needed_replicas_from_vector(vector, query_hpas, *labels)
+        return needed_replicas
+
+    async def async_get_needed_replicas(self, hpas: list[HPA]) -> dict[str, int | None]:
+        """
+        asyncio counterpart of get_needed_replicas.
+        """
+        queries = self.build_queries(hpas)
+        needed_replicas = dict.fromkeys(map(hpa_key, hpas))
+        vectors = await asyncio.gather(*map(self.async_query, queries))
+        for (query_hpas, *labels), vector in zip(queries.values(), vectors):
+            needed_replicas |= self.needed_replicas_from_vector(vector, query_hpas, *labels)
+        return needed_replicas
+
+
+# Set if --prometheus-url is, replaces the custom metrics API.
+PROMETHEUS: PrometheusBackend | None = None
+
+
+def update_target(hpa: HPA, needed_replicas: int | None) -> None:
+    if needed_replicas is None:
+        LOGGER.error(f"Will not update {hpa.target_kind} {hpa.namespace}/{hpa.target_name}.")
+        return
+    # Requests are waiting on the targets to scale up, let their calls go first.
+    token = API_PRIORITY.set(PRIORITY_SCALE_UP if needed_replicas else PRIORITY_DEFAULT)
+    try:
+        if (scale_resource := SCALE_SUBRESOURCES.get(hpa.target_api_version, hpa.target_kind)) is None:
+            LOGGER.error(
+                f"Cannot scale {hpa.target_kind} {hpa.namespace}/{hpa.target_name}, it has no scale subresource."
+            )
+            return
+        scale_target(
+            scale_resource,
+            kind=hpa.target_kind,
+            namespace=hpa.namespace,
+            name=hpa.target_name,
+            needed_replicas=needed_replicas,
+        )
+    finally:
+        API_PRIORITY.reset(token)
+
+
+def scaling_is_needed(*, current_replicas, needed_replicas) -> bool:
+    """
+    checks if the scale up/down is relevant.
+    """
+    # Maybe do not scale down if the HPA is unable to retrieve metrics? leave the current only pod do some work
+    return bool(current_replicas) != bool(needed_replicas)
+
+
+# How long a kind without scale subresource is remembered, its CRD may be installed or updated meanwhile.
+SCALE_SUBRESOURCE_NEGATIVE_TTL = 300
+
+
+class ScaleSubresources:
+    """
+    the scale subresources of the scale targets by (apiVersion, kind), resolved through the DynamicClient's
+    discovery once, so any kind exposing scale (ReplicaSet, Argo Rollout, other CRDs) goes through the same
+    code path. Thread-safe.
+    """
 
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._resolved: dict[tuple[str, str], tuple[float, Subresource | None]] = {}
 
-@dataclass(slots=True, kw_only=True)
-class HPA:
-    name: str
-    namespace: str
-    metric_value_path: str
-    target_kind: str
-    target_name: str
+    def get(self, api_version: str, kind: str) -> Subresource | None:
+        """
+        returns the scale subresource of the kind, None if it has none. Without api_version, the kind must be
+        unique across the API groups.
+        """
+        key = (api_version, kind)
+        with self._lock:
+            resolved_at, scale_resource = self._resolved.get(key, (float("-inf"), None))
+        if scale_resource is not None or monotonic() - resolved_at < SCALE_SUBRESOURCE_NEGATIVE_TTL:
+            return scale_resource
+
+        STATS.inc("scale_subresource_discoveries")
+        try:
+            resource = DYNAMIC.resources.get(**({"api_version": api_version} if api_version else {}), kind=kind)
+            scale_resource = resource.subresources.get("scale")
+        except (ResourceNotFoundError, ResourceNotUniqueError) as exc:
+            LOGGER.error(f"Could not resolve {kind} {api_version=}: {exc}")
+        with self._lock:
+            self._resolved[key] = (monotonic(), scale_resource)
+        return scale_resource
 
 
-SYNC_INTERVAL = 30
-HPAs: dict[str, HPA] = {}
+SCALE_SUBRESOURCES = ScaleSubresources()
+
+# Attempts of a scale patch rejected because the target changed meanwhile (409).
+SCALE_CONFLICT_ATTEMPTS = 3
 
 
-def watch_metrics() -> None:
+def scale_patch(needed_replicas: int, resource_version: str) -> dict:
     """
-    periodically watches metrics of HPA and scale the targets accordingly if needed.
+    returns the JSON merge patch setting spec.replicas, the API server rejects it (409) if the target is not at
+    resource_version anymore.
     """
+    return {"metadata": {"resourceVersion": resource_version}, "spec": {"replicas": needed_replicas}}
 
-    # TODO: See if we can use Kubernetes's watch mechanism
-    def _watch():
+
+def replicas_and_resource_version(scale: dict) -> tuple[int, str]:
+    return scale["status"].get("replicas", 0), scale["metadata"]["resourceVersion"]
+
+
+def read_scale(scale_resource, *, namespace, name) -> tuple[int, str]:
+    """
+    returns the current replicas and the resourceVersion of the scale subresource.
+    """
+    if RAW_JSON:
+        scale = orjson.loads(scale_resource.get(namespace=namespace, name=name, serialize=False).data)
+    else:
+        scale = scale_resource.get(namespace=namespace, name=name).to_dict()
+    return replicas_and_resource_version(scale)
+
+
+def scale_target(scale_resource, *, kind, namespace, name, needed_replicas) -> None:
+    """
+    scales the target, through its scale subresource, if needed, patching spec.replicas only if the target is still
+    at the resourceVersion its current replicas were read at. If it changed meanwhile, its scale is read again and
+    the decision retried.
+    """
+    try:
+        for attempt in range(SCALE_CONFLICT_ATTEMPTS):
+            scale = None if attempt else TARGETS_SCALE.get(target_key(kind, namespace, name))
+            current_replicas, resource_version = scale or read_scale(scale_resource, namespace=namespace, name=name)
+            if not scaling_is_needed(current_replicas=current_replicas, needed_replicas=needed_replicas):
+                LOGGER.info(f"No need to scale {kind} {namespace}/{name} {current_replicas=} {needed_replicas=}.")
+                return
+
+            try:
+                # Maybe do not scale immediately? but don't want to reimplement an HPA.
+                scale_resource.patch(
+                    body=scale_patch(needed_replicas, resource_version),
+                    namespace=namespace,
+                    name=name,
+                    content_type="application/merge-patch+json",
+                )
+            except kubernetes.client.exceptions.ApiException as exc:
+                if exc.status != 409 or attempt == SCALE_CONFLICT_ATTEMPTS - 1:
+                    raise exc
+                STATS.inc("scale_conflicts")
+                LOGGER.info(f"{kind} {namespace}/{name} changed since {resource_version=}, will read it again.")
+                continue
+            LOGGER.info(f"{kind} {namespace}/{name} was scaled {current_replicas=}->{needed_replicas=}.")
+            return
+    except kubernetes.client.exceptions.ApiException as exc:
+        if exc.status != 404:
+            raise exc
+        LOGGER.warning(f"{kind} {namespace}/{name} was not found.")
+
+
+def deserialize(obj: dict, model: str):
+    """
+    returns the OpenAPI model for the raw object, so the code working on the models is shared by both runtimes.
+    """
+    return AUTOSCALING_V1.api_client.deserialize(SimpleNamespace(data=json.dumps(obj)), model)
+
+
+class AsyncKubernetesClient:
+    """
+    minimal Kube API client over one pooled aiohttp session, used by the asyncio runtime.
+    it reuses the configuration (host, TLS, token) loaded by load_kubernetes_config.
+    """
+
+    def __init__(self, *, max_connections: int) -> None:
+        self.configuration = kubernetes.client.Configuration.get_default_copy()
+        self.host = self.configuration.host.rstrip("/")
+        ssl_context = ssl.create_default_context(cafile=self.configuration.ssl_ca_cert)
+        if self.configuration.cert_file:
+            ssl_context.load_cert_chain(self.configuration.cert_file, self.configuration.key_file)
+        if not self.configuration.verify_ssl:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        connect_timeout, read_timeout = REQUEST_TIMEOUT
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max_connections, ssl=ssl_context),
+            # The watches override it.
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+
+    async def __aenter__(self) -> "AsyncKubernetesClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.session.close()
+
+    def _headers(self) -> dict[str, str]:
+        headers = {"Accept": "application/json"}
+        # auth_settings refreshes the token if needed (exec/OIDC plugins).
+        for auth in self.configuration.auth_settings().values():
+            if auth["in"] == "header":
+                headers[auth["key"]] = auth["value"]
+        return headers
+
+    def _url(self, path: str) -> str:
+        return f"{self.host}/{path.lstrip('/')}"
+
+    @staticmethod
+    async def _raise_for_status(response: aiohttp.ClientResponse) -> None:
+        if response.status >= 400:
+            exc = kubernetes.client.exceptions.ApiException(status=response.status, reason=await response.text())
+            exc.headers = response.headers
+            raise exc
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        """
+        sends the request through the rate limiter of the method and CONCURRENCY, returns the JSON response.
+        """
+        await rate_limiter(method).async_acquire(API_PRIORITY.get())
+        start, throttled, delay = await CONCURRENCY.async_acquire(), False, None
         try:
-            while True:
-                for hpa in list(HPAs.values()):
-                    update_target(hpa)
-                sleep(SYNC_INTERVAL)
-        except Exception as exc:
-            LOGGER.exception(f"Exiting because of: {exc}")
-            os._exit(1)
+            async with self.session.request(method, self._url(path), **kwargs) as response:
+                await self._raise_for_status(response)
+                return await response.json(loads=orjson.loads if RAW_JSON else json.loads)
+        except kubernetes.client.exceptions.ApiException as exc:
+            if throttled := exc.status == 429:
+                delay = retry_after(exc.headers)
+            raise exc
+        except asyncio.TimeoutError as exc:
+            throttled = True
+            raise exc
+        finally:
+            CONCURRENCY.release(start, throttled=throttled, retry_after=delay)
 
-    threading.Thread(target=_watch, daemon=True).start()
+    async def get(self, path: str, **params) -> dict:
+        return await self._request("GET", path, params=params, headers=self._headers())
 
+    async def merge_patch(self, path: str, body: dict) -> dict:
+        headers = self._headers() | {"Content-Type": "application/merge-patch+json"}
+        return await self._request("PATCH", path, data=json.dumps(body), headers=headers)
 
-def watch_hpa(args) -> None:
-    LOGGER.info(f"Will watch HPA with {args.hpa_label_selector=} in {args.hpa_namespace=}.")
+    async def watch(self, path: str, **params):
+        """
+        yields the events of the watch until the server closes the stream.
+        """
+        await READ_LIMITER.async_acquire(API_PRIORITY.get())
+        async with self.session.get(
+            self._url(path),
+            params={"watch": "1", **params},
+            headers=self._headers(),
+            timeout=aiohttp.ClientTimeout(total=None),
+        ) as response:
+            await self._raise_for_status(response)
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                event = orjson.loads(line) if RAW_JSON else json.loads(line)
+                if event["type"] == "ERROR":
+                    status = event["object"]
+                    raise kubernetes.client.exceptions.ApiException(
+                        status=status["code"], reason=f"{status.get('reason')}: {status.get('message')}"
+                    )
+                yield event
+
+
+# The kinds whose current replicas are watched with --watch-targets, the scale subresource of the others is read.
+SCALE_RESOURCES = {"Deployment": "deployments", "StatefulSet": "statefulsets"}
+
+
+async def async_watch_metrics(client: AsyncKubernetesClient, args) -> None:
+    """
+    asyncio counterpart of watch_metrics, at most args.sync_workers metrics are fetched concurrently.
+    """
+    semaphore = asyncio.Semaphore(args.sync_workers)
+    # Keep references to the metric fetches that outlived their sweep.
+    late_tasks: set[asyncio.Task] = set()
+
+    async def _get_needed_replicas(metric_path: str) -> dict[str, int] | None:
+        async with semaphore:
+            return await async_get_needed_replicas(client, metric_path)
+
+    async def _get_needed_replicas_once(metric_path: str, refresh: bool, at_zero: bool) -> dict[str, int] | None:
+        # Latency matters when waking up a target, a cached value would also delay it past --zero-sync-interval.
+        fetch = partial(HEDGER.async_call, _get_needed_replicas, hedge=at_zero)
+        return await METRIC_CACHE.async_get(
+            metric_path, partial(METRIC_FLIGHT.async_do, metric_path, fetch), refresh or at_zero
+        )
+
+    async def _sweep(
+        hpas: list[HPA], *, hybrid: bool = False, refresh: bool = False, deadline: float | None = None
+    ) -> dict[str, int | None]:
+        start = monotonic()
+        hpas = interleave_by_namespace(hpas)
+        from_status, polled_hpas = split_by_status(hpas, hybrid=hybrid)
+        if PROMETHEUS is not None:
+            needed_replicas = from_status | await PROMETHEUS.async_get_needed_replicas(polled_hpas)
+        else:
+            groups = group_by_metric_path(polled_hpas)
+            tasks = {
+                metric_path: asyncio.create_task(
+                    _get_needed_replicas_once(metric_path, refresh, any(map(target_at_zero, group)))
+                )
+                for metric_path, group in groups.items()
+            }
+            if tasks:
+                await asyncio.wait(tasks.values(), timeout=None if deadline is None else max(0, deadline - monotonic()))
+            # The late ones keep running, they'll fill METRIC_CACHE for the next sweep.
+            for task in tasks.values():
+                if not task.done():
+                    late_tasks.add(task)
+                    task.add_done_callback(late_tasks.discard)
+            fetched = {metric_path: group for metric_path, group in groups.items() if tasks[metric_path].done()}
+            results = [tasks[metric_path].result() for metric_path in fetched]
+            needed_replicas = from_status | needed_replicas_per_hpa(fetched, results)
+        count_carried_over(hpas, needed_replicas)
+        queue_updates(hpas, needed_replicas)
+        count_sweep(hpas, polled_hpas, start)
+        return needed_replicas
+
+    if args.webhook_port:
+        await async_serve_webhook(args)
+
+    scheduler = new_scheduler(args)
+    while True:
+        due = scheduler.pop_due({hpa_key(hpa): hpa for hpa in selected_hpas(args)}, monotonic())
+        if due:
+            needed_replicas = await _sweep(
+                [hpa for _, hpa in due], hybrid=args.hybrid, deadline=monotonic() + args.sweep_deadline
+            )
+            scheduler.reschedule_sweep(due, needed_replicas)
+        STATS.log(every=SYNC_INTERVAL)
+        await asyncio.sleep(scheduler.wait_time(monotonic()))
+
+
+async def async_serve_webhook(args) -> None:
+    """
+    asyncio counterpart of serve_webhook.
+    """
+
+    async def _post(request: web.Request) -> web.Response:
+        status, hpas = hpas_to_wake(args, request.path, await request.read())
+        if hpas:
+            wake(args, hpas)
+        return web.json_response({"woken": [hpa_key(hpa) for hpa in hpas]}, status=status)
+
+    async def _stats(_: web.Request) -> web.Response:
+        return web.json_response(stats())
+
+    app = web.Application()
+    app.router.add_get("/stats", _stats)
+    app.router.add_post("/{path:.*}", _post)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=args.webhook_port).start()
+    LOGGER.info(f"Will serve the webhook on port {args.webhook_port}.")
+
+
+async def async_watch_hpa(client: AsyncKubernetesClient, args) -> None:
+    LOGGER.info(f"Will watch HPA with {args.hpa_label_selector=} in {watched_namespaces(args)}.")
+    path = f"apis/autoscaling/v1/{namespace_path(args)}horizontalpodautoscalers"
+    resource_version = None
     while True:
         try:
-            w = watch.Watch()
-            for event in w.stream(
-                AUTOSCALING_V1.list_namespaced_horizontal_pod_autoscaler,
-                args.hpa_namespace,
-                label_selector=args.hpa_label_selector,
+            if resource_version is None:
+                resource_version = await async_relist_hpa(client, args, path)
+            async for event in client.watch(
+                path,
+                labelSelector=args.hpa_label_selector,
+                resourceVersion=resource_version,
+                allowWatchBookmarks="true",
             ):
-                update_hpa(event["object"].metadata)
+                resource_version = event["object"]["metadata"]["resourceVersion"]
+                if event["type"] == "BOOKMARK":
+                    continue
+                event["object"] = deserialize(event["object"], "V1HorizontalPodAutoscaler")
+                update_hpa(event, args)
         except kubernetes.client.exceptions.ApiException as exc:
             if exc.status != 410:
                 raise exc
+            LOGGER.info(f"HPA watch from {resource_version=} expired, will relist.")
+            resource_version = None
 
 
-def update_hpa(metadata) -> None:
+async def async_relist_hpa(client: AsyncKubernetesClient, args, path: str) -> str:
     """
-    inserts/updates/deletes the HPA to/in/from HPAs.
+    asyncio counterpart of relist_hpa.
     """
-    hpa_namespace, hpa_name = metadata.namespace, metadata.name
-    namespaced_name = f"{hpa_namespace}/{hpa_name}"
-    try:
-        hpa = AUTOSCALING_V1.read_namespaced_horizontal_pod_autoscaler(namespace=hpa_namespace, name=hpa_name)
-        LOGGER.info(f"HPA: {hpa}")
-        HPAs[namespaced_name] = HPA(
-            name=hpa_name,
-            namespace=hpa_namespace,
-            metric_value_path=build_metric_value_path(hpa),
-            target_kind=hpa.spec.scale_target_ref.kind,
-            target_name=hpa.spec.scale_target_ref.name,
-        )
-    except kubernetes.client.exceptions.ApiException as exc:
-        if exc.status != 404:
-            raise exc
-        LOGGER.info(f"HPA {hpa_namespace}/{hpa_name} was not found, will forget about it.")
-        HPAs.pop(namespaced_name, None)
+    hpas, params = [], {"labelSelector": args.hpa_label_selector, "limit": LIST_PAGE_SIZE}
+    while True:
+        hpa_list = await client.get(path, **params)
+        hpas.extend(deserialize(hpa, "V1HorizontalPodAutoscaler") for hpa in hpa_list["items"])
+        if not (_continue := hpa_list["metadata"].get("continue")):
+            break
+        params["continue"] = _continue
+    replace_hpas(hpas)
+    return hpa_list["metadata"]["resourceVersion"]
 
 
-def build_metric_value_path(hpa) -> str:
+async def async_watch_targets(client: AsyncKubernetesClient, args, kind: str) -> None:
     """
-    returns the Kube API path to retrieve the custom.metrics.k8s.io used metric.
+    asyncio counterpart of watch_targets, for one kind of SCALE_RESOURCES.
     """
-    metrics = json.loads(hpa.metadata.annotations["autoscaling.alpha.kubernetes.io/metrics"])
-    LOGGER.info(f"metrics: {metrics}")
-    try:
-        custom_metric = next(m["external"] for m in metrics if m["type"] == "External")
-        assert not custom_metric.get("selector")
-        target = custom_metric["target"]
-        assert target["kind"] == "Service"
-    except (StopIteration, AssertionError) as e:
-        LOGGER.exception("Only supports ONE CUSTOM metric without selector based on service for now.")
-        raise e
+    path = f"apis/apps/v1/{namespace_path(args)}{SCALE_RESOURCES[kind]}"
+    while True:
+        try:
+            async for event in client.watch(path):
+                metadata = event["object"]["metadata"]
+                key = target_key(kind, metadata["namespace"], metadata["name"])
+                if event["type"] == "DELETED":
+                    TARGETS_SCALE.pop(key, None)
+                else:
+                    TARGETS_SCALE[key] = (
+                        event["object"].get("status", {}).get("replicas", 0),
+                        metadata["resourceVersion"],
+                    )
+        except kubernetes.client.exceptions.ApiException as exc:
+            if exc.status != 410:
+                raise exc
+            for key in [key for key in TARGETS_SCALE if key.startswith(f"{kind}/")]:
+                TARGETS_SCALE.pop(key, None)
 
-    service_namespace = hpa.metadata.namespace
-    service_name = target["name"]
-    metric_name = custom_metric["metricName"]
 
-    return f"apis/custom.metrics.k8s.io/v1beta1/namespaces/{service_namespace}/services/{service_name}/{metric_name}"
+async def async_watch_namespaces(client: AsyncKubernetesClient, args) -> None:
+    """
+    asyncio counterpart of watch_namespaces.
+    """
+    LOGGER.info(f"Will watch namespaces with {args.namespace_label_selector=}.")
+    while True:
+        try:
+            async for event in client.watch("api/v1/namespaces", labelSelector=args.namespace_label_selector):
+                name = event["object"]["metadata"]["name"]
+                if event["type"] == "DELETED":
+                    SELECTED_NAMESPACES.discard(name)
+                else:
+                    SELECTED_NAMESPACES.add(name)
+        except kubernetes.client.exceptions.ApiException as exc:
+            if exc.status != 410:
+                raise exc
+            SELECTED_NAMESPACES.clear()
 
 
-def get_needed_replicas(metric_value_path) -> int | None:
+async def async_get_needed_replicas(client: AsyncKubernetesClient, metric_path) -> dict[str, int] | None:
     """
-    returns 0 if the metric value is 0, and 1 otherwise (HPA will take care of scaling up if needed)
-    returns None, if the needed replicas cannot be determined.
+    asyncio counterpart of get_needed_replicas.
     """
+    breaker = CIRCUIT_BREAKERS.get(metrics_api(metric_path))
+    if not breaker.allow():
+        return None
     try:
-        # We suppose the MetricValueList does contain one item
-        return min(int(DYNAMIC.request("GET", metric_value_path).items[0].value), 1)
+        needed_replicas = needed_replicas_by_service(await client.get(metric_path))
     except kubernetes.client.exceptions.ApiException as exc:
-        match exc.status:
-            case 404 | 503 | 403:
-                LOGGER.exception(f"Could not get Custom metric at {metric_value_path}: {exc}")
-            case _:
-                raise exc
+        breaker.record(not is_backend_failure(exc.status))
+        if exc.status not in (403, 404) and not is_backend_failure(exc.status):
+            raise exc
+        LOGGER.error(f"Could not get Custom metric at {metric_path}: {exc.status} {exc.reason}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        breaker.record(False)
+        LOGGER.error(f"Could not get Custom metric at {metric_path}: {exc!r}")
+    else:
+        breaker.record(True)
+        return needed_replicas
+
+
+async def async_process_work_queue(client: AsyncKubernetesClient) -> None:
+    """
+    asyncio counterpart of process_work_queue.
+    """
+    while True:
+        key, needed_replicas = await WORK_QUEUE.async_get()
+        failed = False
+        try:
+            if (hpa := HPAs.get(key)) is not None:
+                await async_update_target(client, hpa, needed_replicas)
+        except Exception as exc:
+            failed = True
+            LOGGER.exception(f"Could not update the target of {key}, will retry: {exc}")
+        finally:
+            WORK_QUEUE.done(key, failed=failed)
 
 
-def update_target(hpa: HPA) -> None:
-    needed_replicas = get_needed_replicas(hpa.metric_value_path)
+async def async_update_target(client: AsyncKubernetesClient, hpa: HPA, needed_replicas: int | None) -> None:
     if needed_replicas is None:
         LOGGER.error(f"Will not update {hpa.target_kind} {hpa.namespace}/{hpa.target_name}.")
         return
-    # Maybe, be more precise (using target_api_version e.g.?)
-    match hpa.target_kind:
-        case "Deployment":
-            scale_deployment(
-                namespace=hpa.namespace,
-                name=hpa.target_name,
-                needed_replicas=needed_replicas,
-            )
-        case "StatefulSet":
-            scale_statefulset(
-                namespace=hpa.namespace,
-                name=hpa.target_name,
-                needed_replicas=needed_replicas,
+    # See update_target, the queue workers are long-lived tasks, their context is shared by all their keys.
+    token = API_PRIORITY.set(PRIORITY_SCALE_UP if needed_replicas else PRIORITY_DEFAULT)
+    try:
+        # The discovery, if not resolved yet, is blocking (asyncio.to_thread copies the context).
+        scale_resource = await asyncio.to_thread(SCALE_SUBRESOURCES.get, hpa.target_api_version, hpa.target_kind)
+        if scale_resource is None:
+            LOGGER.error(
+                f"Cannot scale {hpa.target_kind} {hpa.namespace}/{hpa.target_name}, it has no scale subresource."
             )
-        case _:
-            raise ValueError(f"Target kind {hpa.target_kind} not supported.")
+            return
+        await async_scale(
+            client,
+            scale_resource.path(name=hpa.target_name, namespace=hpa.namespace),
+            kind=hpa.target_kind,
+            namespace=hpa.namespace,
+            name=hpa.target_name,
+            needed_replicas=needed_replicas,
+        )
+    finally:
+        API_PRIORITY.reset(token)
 
 
-def scaling_is_needed(*, current_replicas, needed_replicas) -> bool:
+async def async_scale(client: AsyncKubernetesClient, path: str, *, kind, namespace, name, needed_replicas) -> None:
     """
-    checks if the scale up/down is relevant.
+    asyncio counterpart of scale_target, path being the scale subresource's.
     """
-    # Maybe do not scale down if the HPA is unable to retrieve metrics? leave the current only pod do some work
-    return bool(current_replicas) != bool(needed_replicas)
-
-
-def scale_deployment(*, namespace, name, needed_replicas) -> None:
     try:
-        scale = APP_V1.read_namespaced_deployment_scale(namespace=namespace, name=name)
-        current_replicas = scale.status.replicas
-        if not scaling_is_needed(current_replicas=current_replicas, needed_replicas=needed_replicas):
-            LOGGER.info(f"No need to scale Deployment {namespace}/{name} {current_replicas=} {needed_replicas=}.")
-            return
+        for attempt in range(SCALE_CONFLICT_ATTEMPTS):
+            scale = None if attempt else TARGETS_SCALE.get(target_key(kind, namespace, name))
+            current_replicas, resource_version = scale or replicas_and_resource_version(await client.get(path))
+            if not scaling_is_needed(current_replicas=current_replicas, needed_replicas=needed_replicas):
+                LOGGER.info(f"No need to scale {kind} {namespace}/{name} {current_replicas=} {needed_replicas=}.")
+                return
 
-        scale.spec.replicas = needed_replicas
-        # Maybe do not scale immediately? but don't want to reimplement an HPA.
-        APP_V1.patch_namespaced_deployment_scale(namespace=namespace, name=name, body=scale)
-        LOGGER.info(f"Deployment {namespace}/{name} was scaled {current_replicas=}->{needed_replicas=}.")
+            try:
+                await client.merge_patch(path, scale_patch(needed_replicas, resource_version))
+            except kubernetes.client.exceptions.ApiException as exc:
+                if exc.status != 409 or attempt == SCALE_CONFLICT_ATTEMPTS - 1:
+                    raise exc
+                STATS.inc("scale_conflicts")
+                LOGGER.info(f"{kind} {namespace}/{name} changed since {resource_version=}, will read it again.")
+                continue
+            LOGGER.info(f"{kind} {namespace}/{name} was scaled {current_replicas=}->{needed_replicas=}.")
+            return
     except kubernetes.client.exceptions.ApiException as exc:
         if exc.status != 404:
             raise exc
-        LOGGER.warning(f"Deployment {namespace}/{name} was not found.")
+        LOGGER.warning(f"{kind} {namespace}/{name} was not found.")
 
 
-def scale_statefulset(*, namespace, name, needed_replicas) -> None:
-    try:
-        scale = APP_V1.read_namespaced_stateful_set_scale(namespace=namespace, name=name)
-        current_replicas = scale.status.replicas
-        if not scaling_is_needed(current_replicas=current_replicas, needed_replicas=needed_replicas):
-            LOGGER.info(f"No need to scale statefulset {namespace}/{name} {current_replicas=} {needed_replicas=}.")
-            return
+# Not forwarded by the activator, see https://www.rfc-editor.org/rfc/rfc9110#section-7.6.1
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
 
-        scale.spec.replicas = needed_replicas
-        # Maybe do not scale immediately? but don't want to reimplement an HPA.
-        APP_V1.patch_namespaced_stateful_set_scale(namespace=namespace, name=name, body=scale)
-        LOGGER.info(f"StatefulSet {namespace}/{name} was scaled {current_replicas=}->{needed_replicas=}.")
-    except kubernetes.client.exceptions.ApiException as exc:
-        if exc.status != 404:
-            raise exc
-        LOGGER.warning(f"StatefulSet {namespace}/{name} was not found.")
+
+def end_to_end_headers(headers) -> CIMultiDict:
+    """
+    returns the headers to forward, the repeated ones (Set-Cookie e.g.) included.
+    """
+    return CIMultiDict((name, value) for name, value in headers.items() if name.lower() not in HOP_BY_HOP_HEADERS)
+
+
+# How long a service with ready endpoints is considered ready by the activator.
+ACTIVATOR_READY_TTL = 5
+ACTIVATOR_POLL_INTERVAL = 0.5
+
+
+def activator_service(host: str) -> tuple[str, str] | None:
+    """
+    returns the (namespace, service) a request to the activator is meant for, from the first two labels of its Host:
+    {service}.{namespace}[.svc.cluster.local][:port].
+    """
+    labels = host.split(":", 1)[0].split(".")
+    if len(labels) < 2 or not all(labels[:2]):
+        return None
+    return labels[1], labels[0]
+
+
+class Activator:
+    """
+    reverse proxy holding the requests for services whose targets are at zero.
+    Instead of failing, a request to a service without ready endpoints triggers the scale up of the targets of the
+    HPAs using that service's metric, then waits for the service to have ready endpoints and is forwarded to it.
+    The held requests are bounded in memory (their bodies, max_buffer bytes in total) and in time (timeout seconds).
+    The Service itself cannot point to the activator (it would forward to itself), put it behind the ingress/gateway
+    or an alias Service named {service}.{namespace} instead.
+    """
+
+    def __init__(self, client: AsyncKubernetesClient, args) -> None:
+        self.client, self.args = client, args
+        self.timeout, self.max_buffer = args.activator_timeout, args.activator_max_buffer
+        self.grace_period = args.activator_grace_period
+        self.buffered = 0
+        self._ready_at: dict[str, float] = {}
+        self._activations: dict[str, asyncio.Task] = {}
+        self.session = aiohttp.ClientSession(auto_decompress=False, timeout=aiohttp.ClientTimeout(total=None))
+
+    async def _is_ready(self, namespace: str, service: str) -> bool:
+        key = f"{namespace}/{service}"
+        if monotonic() - self._ready_at.get(key, float("-inf")) < ACTIVATOR_READY_TTL:
+            return True
+        try:
+            endpoints = await self.client.get(f"api/v1/namespaces/{namespace}/endpoints/{service}")
+        except kubernetes.client.exceptions.ApiException as exc:
+            if exc.status != 404:
+                raise exc
+            return False
+        if any(subset.get("addresses") for subset in endpoints.get("subsets") or []):
+            self._ready_at[key] = monotonic()
+            return True
+        return False
+
+    async def _activate(self, namespace: str, service: str, hpas: list[HPA]) -> None:
+        LOGGER.info(f"Activating {namespace}/{service} for {[hpa_key(hpa) for hpa in hpas]}.")
+        STATS.inc("activator_activations")
+        start = monotonic()
+        # Keep the sweeps from scaling the targets back to zero before the forwarded requests move the metric.
+        activate(hpas, hold=self.timeout + self.grace_period)
+        while not await self._is_ready(namespace, service):
+            await asyncio.sleep(ACTIVATOR_POLL_INTERVAL)
+        hold_activation(hpas, self.grace_period)
+        LOGGER.info(f"{namespace}/{service} is ready after {monotonic() - start:.3f}s.")
+
+    async def _wait_ready(self, namespace: str, service: str, hpas: list[HPA]) -> None:
+        """
+        waits for the service to be ready, all the requests held for a service share one activation.
+        """
+        key = f"{namespace}/{service}"
+        if key not in self._activations:
+            # Bounded, a later request starts a new activation once this one gave up.
+            task = self._activations[key] = asyncio.create_task(
+                asyncio.wait_for(self._activate(namespace, service, hpas), timeout=self.timeout)
+            )
+            task.add_done_callback(lambda _: self._activations.pop(key, None))
+        await asyncio.wait_for(asyncio.shield(self._activations[key]), timeout=self.timeout)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        if (namespaced_service := activator_service(request.host)) is None:
+            return web.Response(status=400, text="Host should be {service}.{namespace}")
+        namespace, service = namespaced_service
+        hpas = [hpa for hpa in selected_hpas(self.args) if hpa.namespace == namespace and service_name(hpa) == service]
+        if not hpas:
+            return web.Response(status=404, text=f"No HPA for {namespace}/{service}")
+
+        body = await request.read()
+        if not await self._is_ready(namespace, service):
+            if self.buffered + len(body) > self.max_buffer:
+                STATS.inc("activator_rejected_requests")
+                return web.Response(status=503, text="Too many held requests")
+            STATS.inc("activator_held_requests")
+            self.buffered += len(body)
+            try:
+                await self._wait_ready(namespace, service, hpas)
+            except asyncio.TimeoutError:
+                STATS.inc("activator_timed_out_requests")
+                return web.Response(status=504, text=f"{namespace}/{service} is not ready yet")
+            except Exception as exc:
+                LOGGER.exception(f"Could not activate {namespace}/{service}: {exc}")
+                return web.Response(status=502, text=f"Could not activate {namespace}/{service}")
+            finally:
+                self.buffered -= len(body)
+        return await self._forward(
+            request, body, f"http://{service}.{namespace}.svc:{self.args.activator_upstream_port}"
+        )
+
+    async def _forward(self, request: web.Request, body: bytes, upstream: str) -> web.StreamResponse:
+        headers = end_to_end_headers(request.headers)
+        response = None
+        try:
+            async with self.session.request(
+                request.method, f"{upstream}{request.rel_url}", headers=headers, data=body, allow_redirects=False
+            ) as upstream_response:
+                response = web.StreamResponse(
+                    status=upstream_response.status,
+                    headers=end_to_end_headers(upstream_response.headers),
+                )
+                await response.prepare(request)
+                async for chunk in upstream_response.content.iter_any():
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        except aiohttp.ClientError as exc:
+            LOGGER.error(f"Could not forward the request to {upstream}: {exc!r}")
+            if response is not None and response.prepared:
+                # Too late for an error response, the connection is dropped.
+                raise exc
+            return web.Response(status=502, text=f"Could not reach {upstream}")
+
+    async def serve(self) -> None:
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, port=self.args.activator_port).start()
+        LOGGER.info(f"Will serve the activator on port {self.args.activator_port}.")
+
+
+async def run_asyncio(args) -> None:
+    """
+    runs the HPA watch and the metrics watch as coroutines sharing one connection pool.
+    """
+    watches = [async_watch_hpa]
+    if args.watch_targets:
+        watches.extend(partial(async_watch_targets, kind=kind) for kind in SCALE_RESOURCES)
+    if args.namespace_label_selector:
+        watches.append(async_watch_namespaces)
+    # Keep connections for the long-lived watches, the metric requests and the queue workers.
+    async with AsyncKubernetesClient(max_connections=2 * args.sync_workers + len(watches)) as client:
+        if args.activator_port:
+            await Activator(client, args).serve()
+        await asyncio.gather(
+            async_watch_metrics(client, args),
+            *(async_process_work_queue(client) for _ in range(args.sync_workers)),
+            *(watch_func(client, args) for watch_func in watches),
+        )
 
 
 def parse_cli_args():
@@ -216,17 +2393,309 @@ def parse_cli_args():
         default="default",
         help="namespace where the HPA live. (default: 'default' namespace)",
     )
+    parser.add_argument(
+        "--all-namespaces",
+        dest="all_namespaces",
+        action="store_true",
+        help="watch the HPA in all namespaces instead of --hpa-namespace, needs cluster-wide permissions. "
+        "(default: disabled)",
+    )
+    parser.add_argument(
+        "--namespace-label-selector",
+        dest="namespace_label_selector",
+        default="",
+        help="with --all-namespaces, only handle the HPA in namespaces matching this label_selector, 'team=foo' e.g. "
+        "(default: empty string to select all)",
+    )
     parser.add_argument(
         "--hpa-label-selector",
         dest="hpa_label_selector",
         default="",
         help="label_selector to get HPA to watch, 'foo=bar,bar=foo' e.g. (default: empty string to select all)",
     )
+    parser.add_argument(
+        "--sync-workers",
+        dest="sync_workers",
+        type=int,
+        default=10,
+        help="maximum number of metrics fetched, and of HPA targets updated, concurrently. (default: 10)",
+    )
+    parser.add_argument(
+        "--sync-jitter",
+        dest="sync_jitter",
+        type=float,
+        default=0.1,
+        help="randomly shift each HPA's next evaluation by up to this fraction of the interval. (default: 0.1)",
+    )
+    parser.add_argument(
+        "--zero-sync-interval",
+        dest="zero_sync_interval",
+        type=float,
+        default=SYNC_INTERVAL,
+        help="seconds between evaluations of an HPA whose target is at zero, a few seconds e.g. for fast wake-ups, "
+        f"its metric is then always fetched, bypassing the metric cache. (default: {SYNC_INTERVAL})",
+    )
+    parser.add_argument(
+        "--max-sync-interval",
+        dest="max_sync_interval",
+        type=float,
+        default=SYNC_INTERVAL,
+        help="the interval of an HPA whose target is active doubles at each evaluation up to this many seconds. "
+        f"(default: {SYNC_INTERVAL})",
+    )
+    parser.add_argument(
+        "--metric-cache-ttl",
+        dest="metric_cache_ttl",
+        type=float,
+        default=10,
+        help="seconds during which a fetched metric value is reused, except for the HPA whose target is at zero. "
+        "(default: 10)",
+    )
+    parser.add_argument(
+        "--metric-cache-stale",
+        dest="metric_cache_stale",
+        type=float,
+        default=20,
+        help="seconds after the TTL during which the cached value is still served while being refreshed. "
+        "(default: 20)",
+    )
+    parser.add_argument(
+        "--metric-cache-size",
+        dest="metric_cache_size",
+        type=int,
+        default=1024,
+        help="maximum number of cached metric values, the least recently used are evicted. (default: 1024)",
+    )
+    parser.add_argument(
+        "--watch-targets",
+        dest="watch_targets",
+        action="store_true",
+        help="watch the Deployments and StatefulSets of the namespace instead of reading the targets' scale before "
+        "each decision, needs list/watch permissions on them. (default: disabled)",
+    )
+    parser.add_argument(
+        "--hybrid",
+        dest="hybrid",
+        action="store_true",
+        help="for targets with replicas, use the metric value the HPA controller writes in the HPA status instead of "
+        "fetching it, only the metrics of targets at zero are fetched. (default: disabled)",
+    )
+    parser.add_argument(
+        "--webhook-port",
+        dest="webhook_port",
+        type=int,
+        default=0,
+        help="serve POST /wake/{namespace}/{hpa} and POST /alertmanager (Alertmanager webhook receiver) on this port "
+        "to scale targets up to one replica right away, and GET /stats. (default: 0, disabled)",
+    )
+    parser.add_argument(
+        "--activator-port",
+        dest="activator_port",
+        type=int,
+        default=0,
+        help="serve the activator, a reverse proxy holding the requests to services whose targets are at zero while "
+        "scaling them up, on this port. Needs --runtime=asyncio. (default: 0, disabled)",
+    )
+    parser.add_argument(
+        "--activator-upstream-port",
+        dest="activator_upstream_port",
+        type=int,
+        default=80,
+        help="port of the services the activator forwards the requests to. (default: 80)",
+    )
+    parser.add_argument(
+        "--activator-timeout",
+        dest="activator_timeout",
+        type=float,
+        default=60,
+        help="seconds a request is held by the activator before giving up with a 504. (default: 60)",
+    )
+    parser.add_argument(
+        "--activator-grace-period",
+        dest="activator_grace_period",
+        type=float,
+        default=60,
+        help="seconds after an activated service is ready, or after a wake, during which a needed replicas of 0 is "
+        "ignored for its HPA, so the incoming requests can show in the metric. (default: 60)",
+    )
+    parser.add_argument(
+        "--activator-max-buffer",
+        dest="activator_max_buffer",
+        type=int,
+        default=16 * 1024 * 1024,
+        help="maximum total size in bytes of the bodies of the requests held by the activator, requests beyond are "
+        "rejected with a 503. (default: 16MiB)",
+    )
+    parser.add_argument(
+        "--prometheus-url",
+        dest="prometheus_url",
+        default="",
+        help="query the metrics directly from this Prometheus, http://prometheus-server e.g., instead of the custom "
+        "metrics API, needs --prometheus-adapter-rules. (default: empty string to use the custom metrics API)",
+    )
+    parser.add_argument(
+        "--prometheus-adapter-rules",
+        dest="prometheus_adapter_rules",
+        default="",
+        help="YAML file with the prometheus-adapter rules defining the metrics, the adapter's config file or the "
+        "values of its Helm chart. Only the rules whose seriesQuery selects one series by name, foo{...} or "
+        '{__name__="foo",...}, are supported, the others ({__name__=~"^foo_.*"} e.g.) are skipped with an error. '
+        "(default: empty string)",
+    )
+    parser.add_argument(
+        "--prometheus-timeout",
+        dest="prometheus_timeout",
+        type=float,
+        default=10,
+        help="timeout in seconds of the Prometheus queries. (default: 10)",
+    )
+    parser.add_argument(
+        "--kube-api-read-qps",
+        dest="kube_api_read_qps",
+        type=float,
+        default=20,
+        help="maximum sustained rate of the Kube API reads (lists, watches, gets), 0 to disable. (default: 20)",
+    )
+    parser.add_argument(
+        "--kube-api-read-burst",
+        dest="kube_api_read_burst",
+        type=int,
+        default=40,
+        help="Kube API reads allowed in a burst above --kube-api-read-qps. (default: 40)",
+    )
+    parser.add_argument(
+        "--kube-api-write-qps",
+        dest="kube_api_write_qps",
+        type=float,
+        default=10,
+        help="maximum sustained rate of the Kube API writes (scale patches), 0 to disable, scale ups go first. "
+        "(default: 10)",
+    )
+    parser.add_argument(
+        "--kube-api-write-burst",
+        dest="kube_api_write_burst",
+        type=int,
+        default=20,
+        help="Kube API writes allowed in a burst above --kube-api-write-qps. (default: 20)",
+    )
+    parser.add_argument(
+        "--circuit-breaker-failures",
+        dest="circuit_breaker_failures",
+        type=int,
+        default=5,
+        help="consecutive failures of a metrics backend (APIService or Prometheus) after which its calls fail fast. "
+        "(default: 5)",
+    )
+    parser.add_argument(
+        "--circuit-breaker-open-duration",
+        dest="circuit_breaker_open_duration",
+        type=float,
+        default=30,
+        help="seconds the calls to a failing metrics backend fail fast before one is let through to probe it. "
+        "(default: 30)",
+    )
+    parser.add_argument(
+        "--kube-api-connect-timeout",
+        dest="kube_api_connect_timeout",
+        type=float,
+        default=5,
+        help="timeout in seconds to connect to the Kube API, watches excepted. (default: 5)",
+    )
+    parser.add_argument(
+        "--kube-api-read-timeout",
+        dest="kube_api_read_timeout",
+        type=float,
+        default=15,
+        help="timeout in seconds to read the Kube API responses (custom metrics included), watches excepted. "
+        "(default: 15)",
+    )
+    parser.add_argument(
+        "--sweep-deadline",
+        dest="sweep_deadline",
+        type=float,
+        default=SYNC_INTERVAL / 2,
+        help="seconds a sweep waits for the metrics of the due HPAs, the HPAs not evaluated by then go first in the "
+        f"next sweep. (default: {SYNC_INTERVAL / 2})",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        dest="hedge_percentile",
+        type=float,
+        default=0,
+        help="for the targets at zero, send a second metric request if the first one takes longer than this "
+        "percentile of the recent ones (95 e.g.), the first to answer wins. (default: 0 to disable)",
+    )
+    parser.add_argument(
+        "--adaptive-concurrency",
+        dest="adaptive_concurrency",
+        action="store_true",
+        help="adapt the number of in-flight Kube API requests, between 1 and twice --sync-workers: grow it while "
+        "they're answered within --adaptive-concurrency-latency, halve it when they're throttled (429, "
+        "Retry-After is honoured) or time out. (default: False)",
+    )
+    parser.add_argument(
+        "--adaptive-concurrency-latency",
+        dest="adaptive_concurrency_latency",
+        type=float,
+        default=1,
+        help="latency in seconds under which the Kube API is considered healthy. (default: 1)",
+    )
+    parser.add_argument(
+        "--raw-json",
+        dest="raw_json",
+        action="store_true",
+        help="parse the metric and scale responses with orjson, only extracting what is needed, instead of building "
+        "the client's objects, cheaper on CPU. (default: False)",
+    )
+    parser.add_argument(
+        "--runtime",
+        dest="runtime",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="'threads' uses the blocking kubernetes client, 'asyncio' runs everything as coroutines over one "
+        "pooled aiohttp session. (default: 'threads')",
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.namespace_label_selector and not args.all_namespaces:
+        parser.error("--namespace-label-selector requires --all-namespaces.")
+    if args.prometheus_url and not args.prometheus_adapter_rules:
+        parser.error("--prometheus-url requires --prometheus-adapter-rules.")
+    if args.activator_port and args.runtime != "asyncio":
+        parser.error("--activator-port requires --runtime=asyncio.")
+    return args
 
 
 if __name__ == "__main__":
     cli_args = parse_cli_args()
-    watch_metrics()
-    watch_hpa(cli_args)
+    METRIC_CACHE = MetricCache(
+        ttl=cli_args.metric_cache_ttl, stale=cli_args.metric_cache_stale, max_size=cli_args.metric_cache_size
+    )
+    READ_LIMITER = RateLimiter(name="read", qps=cli_args.kube_api_read_qps, burst=cli_args.kube_api_read_burst)
+    WRITE_LIMITER = RateLimiter(name="write", qps=cli_args.kube_api_write_qps, burst=cli_args.kube_api_write_burst)
+    HEDGER = Hedger(percentile=cli_args.hedge_percentile, max_workers=2 * cli_args.sync_workers)
+    if cli_args.adaptive_concurrency:
+        CONCURRENCY = ConcurrencyLimiter(
+            initial=cli_args.sync_workers,
+            max_limit=2 * cli_args.sync_workers,
+            latency_target=cli_args.adaptive_concurrency_latency,
+        )
+    RAW_JSON = cli_args.raw_json
+    REQUEST_TIMEOUT = (cli_args.kube_api_connect_timeout, cli_args.kube_api_read_timeout)
+    CIRCUIT_BREAKERS = CircuitBreakers(
+        failure_threshold=cli_args.circuit_breaker_failures, open_duration=cli_args.circuit_breaker_open_duration
+    )
+    if cli_args.prometheus_url:
+        PROMETHEUS = PrometheusBackend.from_rules_file(
+            url=cli_args.prometheus_url, path=cli_args.prometheus_adapter_rules, timeout=cli_args.prometheus_timeout
+        )
+    match cli_args.runtime:
+        case "asyncio":
+            asyncio.run(run_asyncio(cli_args))
+        case _:
+            if cli_args.watch_targets:
+                watch_targets(cli_args)
+            if cli_args.namespace_label_selector:
+                watch_namespaces(cli_args)
+            watch_metrics(cli_args)
+            watch_hpa(cli_args)
@@ -0,0 +1,78 @@
+"""
+compares the parsing of the metric and scale responses, with and without --raw-json.
+Run with: python -m tests.benchmark
+"""
+
+import json
+import timeit
+
+import orjson
+from kubernetes.dynamic.resource import ResourceInstance
+
+from main import DYNAMIC, needed_replicas_by_service, replicas_and_resource_version
+
+SERVICES = 200
+NUMBER = 200
+
+METRIC_VALUE_LIST = json.dumps(
+    {
+        "kind": "MetricValueList",
+        "apiVersion": "custom.metrics.k8s.io/v1beta1",
+        "metadata": {},
+        "items": [
+            {
+                "describedObject": {"kind": "Service", "namespace": "foo", "name": f"service-{i}", "apiVersion": "/v1"},
+                "metricName": "foo_metric",
+                "timestamp": "2022-01-01T00:00:00Z",
+                "value": f"{i % 3}",
+                "selector": None,
+            }
+            for i in range(SERVICES)
+        ],
+    }
+).encode()
+
+SCALE = json.dumps(
+    {
+        "kind": "Scale",
+        "apiVersion": "autoscaling/v1",
+        "metadata": {"name": "foo", "namespace": "foo", "resourceVersion": "1", "uid": "abc"},
+        "spec": {"replicas": 1},
+        "status": {"replicas": 1, "selector": "app=foo"},
+    }
+).encode()
+
+
+def metrics_default() -> dict[str, int]:
+    return needed_replicas_by_service(ResourceInstance(DYNAMIC, json.loads(METRIC_VALUE_LIST)).to_dict())
+
+
+def metrics_raw() -> dict[str, int]:
+    return needed_replicas_by_service(orjson.loads(METRIC_VALUE_LIST))
+
+
+def scale_default() -> tuple[int, str]:
+    return replicas_and_resource_version(ResourceInstance(DYNAMIC, json.loads(SCALE)).to_dict())
+
+
+def scale_raw() -> tuple[int, str]:
+    return replicas_and_resource_version(orjson.loads(SCALE))
+
+
+def main() -> None:
+    assert metrics_default() == metrics_raw()
+    assert scale_default() == scale_raw()
+    for name, default, raw in (
+        (f"MetricValueList ({SERVICES} items)", metrics_default, metrics_raw),
+        ("Scale", scale_default, scale_raw),
+    ):
+        default_time = min(timeit.repeat(default, number=NUMBER, repeat=5)) / NUMBER
+        raw_time = min(timeit.repeat(raw, number=NUMBER, repeat=5)) / NUMBER
+        print(
+            f"{name}: default {default_time * 1e6:.1f}us, --raw-json {raw_time * 1e6:.1f}us, "
+            f"x{default_time / raw_time:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,66 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from time import monotonic, sleep
+from types import SimpleNamespace
 
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer, make_mocked_request
+from kubernetes import client
+from kubernetes.dynamic.exceptions import ResourceNotFoundError
+from multidict import CIMultiDict
 
-from main import build_metric_value_path, scaling_is_needed
+from main import (
+    API_PRIORITY,
+    HPA,
+    PRIORITY_DEFAULT,
+    PRIORITY_SCALE_UP,
+    SELECTED_NAMESPACES,
+    WORK_QUEUE,
+    Activator,
+    AsyncKubernetesClient,
+    CircuitBreaker,
+    CircuitBreakers,
+    ConcurrencyLimiter,
+    Hedger,
+    HPAs,
+    MetricCache,
+    PrometheusBackend,
+    RateLimiter,
+    ScaleSubresources,
+    Scheduler,
+    SingleFlight,
+    Stats,
+    WorkQueue,
+    activator_service,
+    adapt_interval,
+    async_process_work_queue,
+    async_scale,
+    async_update_target,
+    async_watch_hpa,
+    build_metric_value_path,
+    end_to_end_headers,
+    get_needed_replicas,
+    group_by_metric_path,
+    hpa_key,
+    hpas_to_wake,
+    interleave_by_namespace,
+    is_backend_failure,
+    metrics_api,
+    needed_replicas_from_status,
+    needed_replicas_per_hpa,
+    queue_updates,
+    replace_hpas,
+    scaling_is_needed,
+    selected_hpas,
+    store_hpa,
+    sweep,
+    update_hpa,
+    wake,
+)
 
 
 @pytest.mark.parametrize(
@@ -102,3 +160,846 @@ def test_build_metric_value_path(hpa, return_value, exception):
     else:
         with pytest.raises(exception):
             build_metric_value_path(hpa)
+
+
+def _hpa(namespace: str, name: str) -> HPA:
+    return HPA(
+        name=name,
+        namespace=namespace,
+        metric_value_path=f"apis/custom.metrics.k8s.io/v1beta1/namespaces/{namespace}/services/{name}/foo_metric",
+        target_kind="Deployment",
+        target_name=name,
+    )
+
+
+def test_interleave_by_namespace():
+    hpas = [_hpa("foo", "a"), _hpa("foo", "b"), _hpa("foo", "c"), _hpa("bar", "d"), _hpa("baz", "e")]
+    interleaved = interleave_by_namespace(hpas)
+    assert [(hpa.namespace, hpa.name) for hpa in interleaved] == [
+        ("foo", "a"),
+        ("bar", "d"),
+        ("baz", "e"),
+        ("foo", "b"),
+        ("foo", "c"),
+    ]
+
+
+def test_group_by_metric_path():
+    canary = _hpa("baz", "e")
+    canary.name = "e-canary"
+    hpas = [_hpa("foo", "a"), _hpa("foo", "b"), _hpa("bar", "c"), _hpa("baz", "e"), canary]
+    groups = group_by_metric_path(hpas)
+    assert {path: [hpa.name for hpa in group] for path, group in groups.items()} == {
+        "apis/custom.metrics.k8s.io/v1beta1/namespaces/foo/services/*/foo_metric": ["a", "b"],
+        "apis/custom.metrics.k8s.io/v1beta1/namespaces/bar/services/c/foo_metric": ["c"],
+        "apis/custom.metrics.k8s.io/v1beta1/namespaces/baz/services/e/foo_metric": ["e", "e-canary"],
+    }
+
+
+def test_needed_replicas_per_hpa():
+    hpas = [_hpa("foo", "a"), _hpa("foo", "b"), _hpa("foo", "c"), _hpa("bar", "d")]
+    groups = group_by_metric_path(hpas)
+    results = [{"a": 0, "b": 1}, None]
+    assert needed_replicas_per_hpa(groups, results) == {"foo/a": 0, "foo/b": 1, "foo/c": None, "bar/d": None}
+
+
+def test_single_flight():
+    calls = []
+    release = asyncio.Event()
+
+    async def fetch(key):
+        calls.append(key)
+        await release.wait()
+        return len(calls)
+
+    async def _test():
+        flight = SingleFlight()
+        tasks = [asyncio.create_task(flight.async_do("foo", fetch, "foo")) for _ in range(4)]
+        await asyncio.sleep(0)
+        # A cancelled caller leaves the call to the others.
+        tasks[0].cancel()
+        release.set()
+        assert await asyncio.gather(*tasks[1:]) == [1, 1, 1]
+        # The call is over, the next caller makes a new one.
+        assert await flight.async_do("foo", fetch, "foo") == 2
+        assert flight.do("bar", lambda key: key, "bar") == "bar"
+        assert not flight._calls
+
+    asyncio.run(_test())
+    assert calls == ["foo", "foo"]
+
+
+def test_metric_cache(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("main.monotonic", lambda: now[0])
+    values = iter([{"foo": 0}, {"foo": 1}, None, {"foo": 1}])
+    refreshed = threading.Event()
+
+    def fetch(metric_path):
+        value = next(values)
+        refreshed.set()
+        return value
+
+    cache = MetricCache(ttl=10, stale=20, max_size=1)
+    # Miss
+    assert cache.get("foo", fetch) == {"foo": 0}
+    # Fresh
+    now[0] = 10
+    assert cache.get("foo", fetch) == {"foo": 0}
+    # Stale, served while being refreshed in the background
+    refreshed.clear()
+    now[0] = 15
+    assert cache.get("foo", fetch) == {"foo": 0}
+    assert refreshed.wait(timeout=5)
+    for _ in range(100):
+        if cache.get("foo", fetch) == {"foo": 1}:
+            break
+        sleep(0.01)
+    else:
+        pytest.fail("the stale value was not refreshed")
+    # Expired, failures are not cached
+    now[0] = 100
+    assert cache.get("foo", fetch) is None
+    assert cache.get("foo", fetch) == {"foo": 1}
+    # Evicted by another entry
+    cache._store("bar", {"bar": 0})
+    assert cache._lookup("foo") == (None, False)
+
+
+def _v1_hpa(namespace: str, name: str) -> client.V1HorizontalPodAutoscaler:
+    return client.V1HorizontalPodAutoscaler(
+        metadata=client.V1ObjectMeta(
+            namespace=namespace,
+            name=name,
+            generation=1,
+            annotations={"autoscaling.alpha.kubernetes.io/metrics": '[{"type":"External","external":{"target":\
+                {"kind":"Service","name":"foo-service"},"metricName":"foo_metric","targetValue":"15k"}}]'},
+        ),
+        spec=client.V1HorizontalPodAutoscalerSpec(
+            max_replicas=3,
+            scale_target_ref=client.V1CrossVersionObjectReference(kind="Deployment", name=name),
+        ),
+    )
+
+
+def test_store_hpa_skips_status_only_changes():
+    hpa = _v1_hpa("namespace-foo", "foo")
+    store_hpa(hpa)
+    stored = HPAs["namespace-foo/foo"]
+
+    # The HPA controller updates the status
+    hpa.metadata.annotations["autoscaling.alpha.kubernetes.io/current-metrics"] = "[]"
+    store_hpa(hpa)
+    assert HPAs["namespace-foo/foo"] is stored
+
+    # The target changes
+    hpa.metadata.generation = 2
+    hpa.spec.scale_target_ref.name = "bar"
+    store_hpa(hpa)
+    assert HPAs["namespace-foo/foo"].target_name == "bar"
+    HPAs.clear()
+
+
+def test_replace_hpas():
+    replace_hpas([_v1_hpa("namespace-foo", "foo"), _v1_hpa("namespace-foo", "bar")])
+    assert set(HPAs) == {"namespace-foo/foo", "namespace-foo/bar"}
+    # bar was deleted while not watching
+    replace_hpas([_v1_hpa("namespace-foo", "foo")])
+    assert set(HPAs) == {"namespace-foo/foo"}
+    HPAs.clear()
+
+
+def _raw_hpa(namespace: str, name: str, resource_version: str) -> dict:
+    hpa = client.ApiClient().sanitize_for_serialization(_v1_hpa(namespace, name))
+    hpa["metadata"]["resourceVersion"] = resource_version
+    return hpa
+
+
+def test_async_client_watch_maps_error_events():
+    async def _watch(request):
+        assert request.query["watch"] == "1"
+        response = web.StreamResponse()
+        await response.prepare(request)
+        await response.write(json.dumps({"type": "ADDED", "object": {"metadata": {"name": "foo"}}}).encode() + b"\n\n")
+        await response.write(
+            json.dumps(
+                {"type": "ERROR", "object": {"kind": "Status", "code": 410, "reason": "Expired", "message": "too old"}}
+            ).encode()
+            + b"\n"
+        )
+        return response
+
+    async def _test():
+        app = web.Application()
+        app.router.add_get("/apis/foo", _watch)
+        events = []
+        async with TestServer(app) as server, AsyncKubernetesClient(max_connections=1) as kube_client:
+            kube_client.host = str(server.make_url("")).rstrip("/")
+            with pytest.raises(client.exceptions.ApiException) as exc_info:
+                async for event in kube_client.watch("apis/foo"):
+                    events.append(event)
+        return events, exc_info.value
+
+    events, exc = asyncio.run(_test())
+    assert events == [{"type": "ADDED", "object": {"metadata": {"name": "foo"}}}]
+    assert (exc.status, exc.reason) == (410, "Expired: too old")
+
+
+def test_async_watch_hpa_relists_when_expired():
+    class _Client:
+        def __init__(self):
+            self.watches = []
+
+        async def get(self, path, **params):
+            return {"metadata": {"resourceVersion": "1"}, "items": [_raw_hpa("foo", "a", "1")]}
+
+        async def watch(self, path, **params):
+            self.watches.append(params["resourceVersion"])
+            if len(self.watches) == 1:
+                yield {"type": "BOOKMARK", "object": {"metadata": {"resourceVersion": "2"}}}
+                yield {"type": "ADDED", "object": _raw_hpa("foo", "b", "3")}
+                raise client.exceptions.ApiException(status=410)
+            yield {"type": "DELETED", "object": _raw_hpa("foo", "a", "4")}
+            raise client.exceptions.ApiException(status=500)
+
+    fake_client = _Client()
+    args = SimpleNamespace(hpa_label_selector="", all_namespaces=False, hpa_namespace="foo", hybrid=False)
+    try:
+        with pytest.raises(client.exceptions.ApiException):
+            asyncio.run(async_watch_hpa(fake_client, args))
+        # Relisted after the 410, b was deleted while not watching.
+        assert fake_client.watches == ["1", "1"]
+        assert not HPAs
+    finally:
+        HPAs.clear()
+
+
+def test_selected_hpas():
+    HPAs.update({"foo/a": _hpa("foo", "a"), "bar/b": _hpa("bar", "b")})
+    SELECTED_NAMESPACES.add("foo")
+    try:
+        assert len(selected_hpas(SimpleNamespace(namespace_label_selector=""))) == 2
+        assert [hpa.name for hpa in selected_hpas(SimpleNamespace(namespace_label_selector="team=foo"))] == ["a"]
+    finally:
+        HPAs.clear()
+        SELECTED_NAMESPACES.clear()
+
+
+@pytest.mark.parametrize(
+    "current_replicas, conditions, current_metrics, return_value",
+    [
+        (2, "True", '[{"type":"External","external":{"metricName":"foo_metric","currentValue":"0"}}]', 0),
+        (2, "True", '[{"type":"External","external":{"metricName":"foo_metric","currentValue":"500m"}}]', 1),
+        (2, "True", '[{"type":"External","external":{"metricName":"bar_metric","currentValue":"0"}}]', None),
+        # The HPA controller cannot get the metric
+        (2, "False", '[{"type":"External","external":{"metricName":"foo_metric","currentValue":"0"}}]', None),
+        # The target is at zero, ScalingDisabled
+        (0, "False", "[]", None),
+    ],
+)
+def test_needed_replicas_from_status(current_replicas, conditions, current_metrics, return_value):
+    hpa = _v1_hpa("namespace-foo", "foo")
+    hpa.status = client.V1HorizontalPodAutoscalerStatus(current_replicas=current_replicas, desired_replicas=1)
+    hpa.metadata.annotations["autoscaling.alpha.kubernetes.io/conditions"] = (
+        f'[{{"type":"ScalingActive","status":"{conditions}"}}]'
+    )
+    hpa.metadata.annotations["autoscaling.alpha.kubernetes.io/current-metrics"] = current_metrics
+    assert needed_replicas_from_status(hpa, metric_name="foo_metric") == return_value
+
+
+def test_update_hpa_hybrid_skips_unselected_namespaces(monkeypatch):
+    queue = WorkQueue(base_delay=1, max_delay=1)
+    monkeypatch.setattr("main.WORK_QUEUE", queue)
+    hpa = _v1_hpa("namespace-foo", "foo")
+    hpa.status = client.V1HorizontalPodAutoscalerStatus(current_replicas=2, desired_replicas=1)
+    hpa.metadata.annotations["autoscaling.alpha.kubernetes.io/conditions"] = (
+        '[{"type":"ScalingActive","status":"True"}]'
+    )
+    hpa.metadata.annotations["autoscaling.alpha.kubernetes.io/current-metrics"] = (
+        '[{"type":"External","external":{"metricName":"foo_metric","currentValue":"0"}}]'
+    )
+    args = SimpleNamespace(hybrid=True, namespace_label_selector="team=foo")
+    try:
+        update_hpa({"type": "ADDED", "object": hpa}, args)
+        assert len(queue) == 0
+        # The namespace now matches the selector.
+        SELECTED_NAMESPACES.add("namespace-foo")
+        HPAs.clear()
+        update_hpa({"type": "ADDED", "object": hpa}, args)
+        assert queue.get() == ("namespace-foo/foo", 0)
+    finally:
+        HPAs.clear()
+        SELECTED_NAMESPACES.clear()
+
+
+def test_scheduler():
+    hpas = {f"foo/{name}": _hpa("foo", name) for name in ("a", "b", "c")}
+    scheduler = Scheduler(interval=30, jitter=0)
+    # Spread over the interval
+    assert [(due_time, hpa.name) for due_time, hpa in scheduler.pop_due(hpas, 0)] == [(0, "a")]
+    assert scheduler.wait_time(0) == 1
+    assert scheduler.pop_due(hpas, 9.5) == []
+    assert [(due_time, hpa.name) for due_time, hpa in scheduler.pop_due(hpas, 20)] == [(10, "b"), (20, "c")]
+    # Rescheduled one interval after the due time
+    scheduler.reschedule(hpas["foo/a"], 0, 1)
+    # Overrun
+    scheduler.reschedule(hpas["foo/b"], 10, 50)
+    del hpas["foo/c"]
+    assert [(due_time, hpa.name) for due_time, hpa in scheduler.pop_due(hpas, 50)] == [(30, "a"), (50, "b")]
+    assert scheduler.wait_time(50) == 1
+
+
+@pytest.mark.parametrize(
+    "interval, needed_replicas, return_value",
+    [
+        # The target is at zero
+        (30, 0, 3),
+        (3, 0, 3),
+        # The target is active, relax
+        (3, 1, 6),
+        (96, 1, 120),
+        (120, 1, 120),
+        # Unknown
+        (12, None, 12),
+    ],
+)
+def test_adapt_interval(interval, needed_replicas, return_value):
+    assert adapt_interval(interval, needed_replicas, zero_interval=3, max_interval=120) == return_value
+
+
+@pytest.mark.parametrize(
+    "path, body, status, woken",
+    [
+        ("/wake/foo/a", b"", 202, ["foo/a"]),
+        ("/wake/foo/c", b"", 404, []),
+        (
+            "/alertmanager",
+            b'{"alerts": [{"status": "firing", "labels": {"namespace": "foo", "service": "b"}},\
+            {"status": "firing", "labels": {"namespace": "foo", "horizontalpodautoscaler": "a"}},\
+            {"status": "resolved", "labels": {"namespace": "bar", "service": "a"}}]}',
+            202,
+            ["foo/b", "foo/a"],
+        ),
+        ("/alertmanager", b"not json", 400, []),
+        ("/foo", b"", 404, []),
+    ],
+)
+def test_hpas_to_wake(path, body, status, woken):
+    HPAs.update({"foo/a": _hpa("foo", "a"), "foo/b": _hpa("foo", "b"), "bar/a": _hpa("bar", "a")})
+    try:
+        returned_status, hpas = hpas_to_wake(SimpleNamespace(namespace_label_selector=""), path, body)
+        assert (returned_status, [f"{hpa.namespace}/{hpa.name}" for hpa in hpas]) == (status, woken)
+    finally:
+        HPAs.clear()
+
+
+def test_wake_scales_up_without_waiting_for_the_metric(monkeypatch):
+    queue = WorkQueue(base_delay=1, max_delay=1)
+    monkeypatch.setattr("main.WORK_QUEUE", queue)
+    monkeypatch.setattr("main.ACTIVATION_HOLDS", {})
+    hpa = _hpa("foo", "a")
+    wake(SimpleNamespace(activator_grace_period=30), [hpa])
+    assert queue.get() == ("foo/a", 1)
+    queue.done("foo/a")
+    # The metric doesn't reflect the incoming requests yet.
+    queue_updates([hpa], {"foo/a": 0})
+    assert len(queue) == 0
+
+
+@pytest.mark.parametrize(
+    "host, return_value",
+    [
+        ("foo-service.namespace-foo", ("namespace-foo", "foo-service")),
+        ("foo-service.namespace-foo.svc.cluster.local:8080", ("namespace-foo", "foo-service")),
+        ("foo-service", None),
+        (".namespace-foo", None),
+    ],
+)
+def test_activator_service(host, return_value):
+    assert activator_service(host) == return_value
+
+
+def _activator_args() -> SimpleNamespace:
+    return SimpleNamespace(activator_timeout=1, activator_max_buffer=1024, activator_grace_period=30)
+
+
+def test_activator_scales_the_targets_up(monkeypatch):
+    class _Client:
+        def __init__(self):
+            self.patches = []
+
+        async def get(self, path):
+            if "/endpoints/" in path:
+                return {"subsets": [{"addresses": [{"ip": "10.0.0.1"}]}] if self.patches else []}
+            return {"metadata": {"resourceVersion": "1"}, "status": {"replicas": 0}}
+
+        async def merge_patch(self, path, body):
+            self.patches.append((path, body))
+            return {}
+
+    scale_resource = SimpleNamespace(
+        path=lambda name, namespace: f"/apis/apps/v1/namespaces/{namespace}/deployments/{name}/scale"
+    )
+    monkeypatch.setattr("main.SCALE_SUBRESOURCES", SimpleNamespace(get=lambda api_version, kind: scale_resource))
+    monkeypatch.setattr("main.ACTIVATOR_POLL_INTERVAL", 0.01)
+    queue = WorkQueue(base_delay=1, max_delay=1)
+    monkeypatch.setattr("main.WORK_QUEUE", queue)
+    monkeypatch.setattr("main.ACTIVATION_HOLDS", {})
+    hpa = _hpa("foo", "foo-service")
+    monkeypatch.setattr("main.HPAs", {hpa_key(hpa): hpa})
+    fake_client = _Client()
+
+    async def _activate():
+        activator = Activator(fake_client, _activator_args())
+        # The activator only queues the targets' update, the queue workers scale them.
+        worker = asyncio.create_task(async_process_work_queue(fake_client))
+        try:
+            await activator._wait_ready("foo", "foo-service", [hpa])
+        finally:
+            worker.cancel()
+            await activator.session.close()
+
+    asyncio.run(_activate())
+    assert fake_client.patches == [
+        (
+            "/apis/apps/v1/namespaces/foo/deployments/foo-service/scale",
+            {"metadata": {"resourceVersion": "1"}, "spec": {"replicas": 1}},
+        )
+    ]
+    # The next sweeps don't scale the target back to zero before the forwarded requests show in the metric.
+    queue_updates([hpa], {hpa_key(hpa): 0})
+    assert len(queue) == 0
+
+
+def test_activator_gives_up_on_targets_never_ready(monkeypatch):
+    class _Client:
+        async def get(self, path):
+            return {"subsets": []}
+
+    monkeypatch.setattr("main.ACTIVATOR_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr("main.WORK_QUEUE", WorkQueue(base_delay=1, max_delay=1))
+    monkeypatch.setattr("main.ACTIVATION_HOLDS", {})
+    args = _activator_args()
+    args.activator_timeout = 0.05
+
+    async def _activate():
+        activator = Activator(_Client(), args)
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await activator._wait_ready("foo", "foo-service", [_hpa("foo", "foo-service")])
+            await asyncio.sleep(0.01)
+            # A later request starts a new activation.
+            return activator._activations
+        finally:
+            await activator.session.close()
+
+    assert asyncio.run(_activate()) == {}
+
+
+def test_async_update_target_resets_the_priority(monkeypatch):
+    priorities = []
+
+    class _Client:
+        async def get(self, path):
+            return {"metadata": {"resourceVersion": "1"}, "status": {"replicas": 0}}
+
+        async def merge_patch(self, path, body):
+            priorities.append(API_PRIORITY.get())
+            return {}
+
+    scale_resource = SimpleNamespace(path=lambda name, namespace: f"/apis/apps/v1/namespaces/{namespace}/foo/{name}")
+    monkeypatch.setattr("main.SCALE_SUBRESOURCES", SimpleNamespace(get=lambda api_version, kind: scale_resource))
+
+    async def _update():
+        await async_update_target(_Client(), _hpa("foo", "foo-service"), 1)
+        # The same queue worker then handles the next key.
+        return API_PRIORITY.get()
+
+    assert asyncio.run(_update()) == PRIORITY_DEFAULT
+    assert priorities == [PRIORITY_SCALE_UP]
+
+
+def test_end_to_end_headers_keeps_the_repeated_ones():
+    headers = CIMultiDict([("Set-Cookie", "a=1"), ("Set-Cookie", "b=2"), ("Connection", "close")])
+    assert end_to_end_headers(headers).getall("Set-Cookie") == ["a=1", "b=2"]
+    assert "Connection" not in end_to_end_headers(headers)
+
+
+def test_activator_answers_502_if_the_upstream_is_unreachable():
+    async def _forward():
+        activator = Activator(None, _activator_args())
+        try:
+            # Nothing listens on port 1.
+            return await activator._forward(make_mocked_request("GET", "/foo"), b"", "http://127.0.0.1:1")
+        finally:
+            await activator.session.close()
+
+    assert asyncio.run(_forward()).status == 502
+
+
+@pytest.mark.parametrize(
+    "series_query, return_value",
+    [
+        ('foo_metric{namespace!="", service!=""}', "foo_metric"),
+        ('{__name__="foo_metric", namespace!=""}', "foo_metric"),
+        # Several series, they would have to be discovered.
+        ('{__name__=~"^foo_.*", namespace!=""}', None),
+    ],
+)
+def test_prometheus_backend_series_name(series_query, return_value):
+    assert PrometheusBackend._series_name(series_query) == return_value
+
+
+def test_prometheus_backend_batches_hpas_by_metric():
+    backend = PrometheusBackend.from_rules_file(
+        url="http://prometheus", path="tests/manifests/prometheus-adapter-values.yaml", timeout=1
+    )
+    hpas = [_hpa("ns1", "a"), _hpa("ns2", "b")]
+
+    queries = backend.build_queries(hpas)
+
+    assert list(queries) == ['sum(foo_metric{namespace=~"ns1|ns2",service=~"a|b"}) by (namespace,service)']
+    query_hpas, namespace_label, service_label = queries[next(iter(queries))]
+    vector = [
+        {"metric": {"namespace": "ns1", "service": "a"}, "value": [0, "0.5"]},
+        {"metric": {"namespace": "ns2", "service": "a"}, "value": [0, "3"]},
+        {"metric": {"namespace": "ns2", "service": "b"}, "value": [0, "NaN"]},
+    ]
+    assert backend.needed_replicas_from_vector(vector, query_hpas, namespace_label, service_label) == {
+        "ns1/a": 1,
+        "ns2/b": None,
+    }
+    assert backend.needed_replicas_from_vector(None, query_hpas, namespace_label, service_label) == {
+        "ns1/a": None,
+        "ns2/b": None,
+    }
+
+
+def test_rate_limiter_serves_scale_ups_first(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("main.monotonic", lambda: now)
+    limiter = RateLimiter(name="write", qps=2, burst=1)
+    limiter.acquire()
+
+    other = limiter._enqueue(PRIORITY_DEFAULT)
+    scale_up = limiter._enqueue(PRIORITY_SCALE_UP)
+    # No token left.
+    assert limiter._poll(scale_up) == pytest.approx(0.5)
+    now = 0.5
+    assert limiter._poll(other) > 0
+    assert limiter._poll(scale_up) == 0
+    assert limiter._poll(other) == pytest.approx(0.5)
+    now = 1.0
+    assert limiter._poll(other) == 0
+
+
+def test_rate_limiter_only_counts_the_waits(monkeypatch):
+    stats = Stats()
+    monkeypatch.setattr("main.STATS", stats)
+    limiter = RateLimiter(name="read", qps=100, burst=1)
+    limiter.acquire()
+    assert stats.snapshot() == {}
+    # No token left.
+    limiter.acquire()
+    assert stats.snapshot()["read_rate_limiter_waits"] == 1
+
+
+def test_work_queue_dedupes_and_serializes_keys(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("main.monotonic", lambda: now)
+    queue = WorkQueue(base_delay=1, max_delay=4)
+
+    queue.add("ns/a", 0)
+    queue.add("ns/b", 0)
+    queue.add("ns/a", 1)
+    assert queue.get() == ("ns/a", 1)
+    # Queued again while processed, not handed to another worker until done.
+    queue.add("ns/a", 2)
+    assert queue.get() == ("ns/b", 0)
+    assert queue._pop(now) == float("inf")
+    queue.done("ns/b")
+    queue.done("ns/a")
+    assert queue.get() == ("ns/a", 2)
+    assert len(queue) == 0
+
+
+def test_work_queue_backs_off_failed_keys(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("main.monotonic", lambda: now)
+    queue = WorkQueue(base_delay=1, max_delay=3)
+
+    queue.add("ns/a", 1)
+    for delay in (1, 2, 3, 3):
+        assert queue.get() == ("ns/a", 1)
+        queue.done("ns/a", failed=True)
+        assert queue._pop(now) == delay
+        now += delay
+    assert queue.get() == ("ns/a", 1)
+    queue.done("ns/a")
+    assert queue._failures == {}
+
+
+def test_circuit_breaker(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("main.monotonic", lambda: now)
+    breaker = CircuitBreaker(name="custom.metrics.k8s.io/v1beta1", failure_threshold=2, open_duration=10)
+
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    now = 10.0
+    # One probe only.
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    now = 20.0
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_sweep_carries_over_hpas_past_deadline(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def _get_needed_replicas(metric_path):
+        calls.append(metric_path)
+        if "/slow/" in metric_path:
+            release.wait()
+        return {"foo-service": 1}
+
+    monkeypatch.setattr("main.get_needed_replicas", _get_needed_replicas)
+    fast, slow = _hpa("fast", "foo-service"), _hpa("slow", "foo-service")
+    scheduler = Scheduler(interval=30, jitter=0)
+    hpas = {"fast/foo-service": fast, "slow/foo-service": slow}
+    due = scheduler.pop_due(hpas, 0) + scheduler.pop_due(hpas, 15)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        needed_replicas = sweep(executor, [fast, slow], refresh=True, deadline=monotonic() + 0.2)
+        # The next sweep joins the fetch still in flight.
+        assert sweep(executor, [slow], refresh=True, deadline=monotonic() + 0.2) == {}
+        release.set()
+    assert needed_replicas == {"fast/foo-service": 1}
+    assert len(calls) == 2
+    assert WORK_QUEUE.get() == ("fast/foo-service", 1)
+    WORK_QUEUE.done("fast/foo-service")
+    assert len(WORK_QUEUE) == 0
+
+    scheduler.reschedule_sweep(due, needed_replicas)
+    assert [(due_time, hpa.namespace) for due_time, hpa in scheduler.pop_due(hpas, 15)] == [(15, "slow")]
+
+
+def test_sweep_bypasses_the_metric_cache_for_targets_at_zero(monkeypatch):
+    calls = []
+
+    def _get_needed_replicas(metric_path):
+        calls.append(metric_path)
+        return {"foo-service": 0}
+
+    monkeypatch.setattr("main.get_needed_replicas", _get_needed_replicas)
+    monkeypatch.setattr("main.METRIC_CACHE", MetricCache(ttl=10, stale=20, max_size=1))
+    hpa = _hpa("foo", "foo-service")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert sweep(executor, [hpa]) == {"foo/foo-service": 0}
+        WORK_QUEUE.done(WORK_QUEUE.get()[0])
+        # The target is now at zero, its metric is fetched again.
+        assert sweep(executor, [hpa]) == {"foo/foo-service": 0}
+        WORK_QUEUE.done(WORK_QUEUE.get()[0])
+    assert len(calls) == 2
+
+
+def test_sweep_counts_its_duration(monkeypatch):
+    stats = Stats()
+    monkeypatch.setattr("main.STATS", stats)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert sweep(executor, []) == {}
+    assert stats.snapshot()["sweeps"] == 1
+    assert stats.snapshot()["sweep_seconds"] >= 0
+
+
+def test_hedger_takes_the_first_result():
+    hedger = Hedger(percentile=90, max_workers=2)
+    assert hedger.call(lambda: "fast", hedge=True) == "fast"
+    assert hedger.delay() is None
+    for _ in range(30):
+        hedger.call(sleep, 0.001)
+
+    calls = []
+    release = threading.Event()
+
+    def _get():
+        calls.append(None)
+        if len(calls) == 1:
+            # The first one stalls.
+            release.wait()
+            return "slow"
+        return "hedge"
+
+    assert hedger.call(_get, hedge=True) == "hedge"
+    assert len(calls) == 2
+    release.set()
+    hedger._executor.shutdown(wait=True)
+    # Only the winner is recorded.
+    assert len(hedger._durations) == 32
+
+
+def test_hedger_cancels_and_forgets_the_losing_call():
+    hedger = Hedger(percentile=90, max_workers=1)
+    calls = []
+
+    async def _get():
+        calls.append(None)
+        if len(calls) == 1:
+            # The first one stalls.
+            await asyncio.sleep(5)
+            return "slow"
+        return "hedge"
+
+    async def _test():
+        for _ in range(30):
+            await hedger.async_call(asyncio.sleep, 0.001)
+        return await hedger.async_call(_get, hedge=True)
+
+    assert asyncio.run(_test()) == "hedge"
+    assert len(calls) == 2
+    assert len(hedger._durations) == 31
+
+
+def test_concurrency_limiter_aimd(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("main.monotonic", lambda: now)
+    limiter = ConcurrencyLimiter(initial=2, max_limit=3, latency_target=1)
+
+    starts = [limiter.acquire(), limiter.acquire()]
+    assert limiter._try_acquire(now) == float("inf")
+    for start in starts:
+        limiter.release(start)
+    # Additive increase, 1/limit per healthy request.
+    assert limiter.limit == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+    # Slow, kept.
+    now = 2.0
+    limiter.release(limiter.acquire() - 2)
+    assert limiter.limit == pytest.approx(2.9)
+
+    # Multiplicative decrease, once per latency_target, and Retry-After.
+    starts = [limiter.acquire(), limiter.acquire()]
+    limiter.release(starts[0], throttled=True, retry_after=5)
+    limiter.release(starts[1], throttled=True)
+    assert limiter.limit == pytest.approx(1.45)
+    assert limiter._try_acquire(now) == 5
+    now = 7.0
+    assert limiter._try_acquire(now) == 0
+
+
+def test_async_scale_retries_on_conflict():
+    class _Client:
+        def __init__(self):
+            self.patches = []
+
+        async def get(self, path):
+            return {"metadata": {"resourceVersion": str(len(self.patches))}, "status": {}}
+
+        async def merge_patch(self, path, body):
+            self.patches.append(body)
+            if len(self.patches) == 1:
+                raise client.exceptions.ApiException(status=409)
+            return {}
+
+    fake_client = _Client()
+    asyncio.run(
+        async_scale(
+            fake_client,
+            "/apis/apps/v1/namespaces/foo/deployments/bar/scale",
+            kind="Deployment",
+            namespace="foo",
+            name="bar",
+            needed_replicas=1,
+        )
+    )
+    assert fake_client.patches == [
+        {"metadata": {"resourceVersion": "0"}, "spec": {"replicas": 1}},
+        {"metadata": {"resourceVersion": "1"}, "spec": {"replicas": 1}},
+    ]
+
+
+def test_scale_subresources_are_resolved_once(monkeypatch):
+    now = 0.0
+    monkeypatch.setattr("main.monotonic", lambda: now)
+    lookups = []
+
+    def _get(**kwargs):
+        lookups.append(kwargs)
+        if kwargs["kind"] == "Rollout":
+            return SimpleNamespace(subresources={"scale": "rollouts/scale"})
+        if kwargs["kind"] == "ConfigMap":
+            return SimpleNamespace(subresources={})
+        raise ResourceNotFoundError("No matches found")
+
+    monkeypatch.setattr("main.DYNAMIC", SimpleNamespace(resources=SimpleNamespace(get=_get)))
+    scale_subresources = ScaleSubresources()
+
+    for _ in range(2):
+        assert scale_subresources.get("argoproj.io/v1alpha1", "Rollout") == "rollouts/scale"
+        assert scale_subresources.get("", "ConfigMap") is None
+        assert scale_subresources.get("foo.io/v1", "Foo") is None
+    assert lookups == [
+        {"api_version": "argoproj.io/v1alpha1", "kind": "Rollout"},
+        {"kind": "ConfigMap"},
+        {"api_version": "foo.io/v1", "kind": "Foo"},
+    ]
+    # The kinds without scale subresource are resolved again after a while.
+    now = 300.0
+    assert scale_subresources.get("foo.io/v1", "Foo") is None
+    assert len(lookups) == 4
+
+
+def test_rate_limiter_forgets_cancelled_waiters():
+    limiter = RateLimiter(name="read", qps=20, burst=1)
+
+    async def _acquire():
+        limiter.acquire()
+        waiter = asyncio.create_task(limiter.async_acquire())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.wait_for(limiter.async_acquire(), timeout=1)
+
+    asyncio.run(_acquire())
+    assert limiter._waiters == []
+
+
+@pytest.mark.parametrize(
+    "status, return_value",
+    [
+        # No series for the metric or the service
+        (404, False),
+        (403, False),
+        (429, True),
+        (503, True),
+        # No response
+        (None, True),
+    ],
+)
+def test_is_backend_failure(status, return_value):
+    assert is_backend_failure(status) == return_value
+
+
+def test_get_needed_replicas_opens_the_breaker_on_server_errors(monkeypatch):
+    def _request(method, path, **kwargs):
+        raise client.exceptions.ApiException(status=500)
+
+    monkeypatch.setattr("main.DYNAMIC", SimpleNamespace(request=_request))
+    breakers = CircuitBreakers(failure_threshold=2, open_duration=30)
+    monkeypatch.setattr("main.CIRCUIT_BREAKERS", breakers)
+    metric_path = _hpa("foo", "foo-service").metric_value_path
+    assert get_needed_replicas(metric_path) is None
+    assert get_needed_replicas(metric_path) is None
+    assert breakers.get(metrics_api(metric_path)).state == "open"